@@ -2,6 +2,7 @@ import main
 import nanopq
 import numpy as np
 import copy
+import pickle
 
 class Rii(object):
     """Reconfigurable Inverted Index (Rii) [Matsui18]_.
@@ -74,22 +75,21 @@ class Rii(object):
         if self.nlist == 0:
             return None
         else:
-            return np.array(self.impl_cpp.coarse_centers,
-                            dtype=self.fine_quantizer.code_dtype)
+            return self.impl_cpp.coarse_centers.astype(self.fine_quantizer.code_dtype, copy=False)
 
     @property
     def codes(self):
         """np.ndarray: The database PQ-codes, where shape=(N, M) with dtype=np.uint8.
-        Accessing this property would be slow because the whole data
-        is converted online from std::vector<unsigned char> in the cpp-instance to np.array.
+        Accessing this property copies the whole codes from the cpp-instance to a new np.array
+        (a single memory copy), so please avoid calling it repeatedly.
         If vectors have not been added yet (i.e., :func:`add` or :func:`add_configure` has not been called),
         this returns None.
         """
         if self.N == 0:
             return None
         else:
-            return np.array(self.impl_cpp.flattened_codes,
-                            dtype=self.fine_quantizer.code_dtype).reshape(self.N, self.M)
+            return self.impl_cpp.flattened_codes.astype(
+                self.fine_quantizer.code_dtype, copy=False).reshape(self.N, self.M)
 
     @property
     def posting_lists(self):
@@ -97,8 +97,12 @@ class Rii(object):
         identifiers. List of list. Note that ``len(posting_lists) == nlist``,
         and ``posting_lists[no]`` contains the IDs of PQ-codes
         (a list of int), where their nearest coarse_center is no-th one.
+        Internally, posting lists are stored as two flat arrays (CSR format),
+        and this list of list is created from them on access.
         """
-        return self.impl_cpp.posting_lists
+        offsets = self.impl_cpp.posting_list_offsets
+        ids = self.impl_cpp.posting_list_ids
+        return [ids[offsets[no]:offsets[no + 1]].tolist() for no in range(len(offsets) - 1)]
 
     @property
     def verbose(self):
@@ -182,8 +186,9 @@ class Rii(object):
         assert vecs.ndim == 2
         assert vecs.dtype == np.float32
 
-        self.impl_cpp.add_codes(self.fine_quantizer.encode(vecs),
-                                self._resolve_update_posting_lists_flag(update_posting_lists))
+        # Encoding (and updating posting lists) is done in a single pass in cpp
+        self.impl_cpp.add_vecs(self._rotate(vecs),
+                               self._resolve_update_posting_lists_flag(update_posting_lists))
 
     def add_configure(self, vecs, nlist=None, iter=5):
         """Run :func:`add` (with ``update_postig_lists=False``) and :func:`reconfigure`.
@@ -245,6 +250,10 @@ class Rii(object):
         'linear' or 'ivf'. If 'auto' is set, the faster one is automatically selected
         (See Alg. 3 in the paper for more details).
 
+        The search itself runs without holding the GIL, so queries issued from several Python threads
+        are processed concurrently. Note that the instance must not be modified (e.g., by :func:`add`
+        or :func:`clear`) while it is being searched.
+
         See :ref:`guideline_for_search` for tips of the parameter selection.
 
         Args:
@@ -273,51 +282,51 @@ class Rii(object):
                 The second one is the distances of the items to the query, with the shape=(topk, ) and dtype=float64
 
         """
-        assert 0 < self.N   # Make sure there are codes to be searched
-        assert 0 < self.nlist   # Make sure posting lists are available
-        assert method in ["auto", "linear", "ivf"]
+        topk, L, tids, method = self._resolve_query_params(topk, L, target_ids, sort_target_ids, method)
 
-        if topk is None:
-            topk = self.N
-        assert 1 <= topk <= self.N
+        q_ = self._rotate(q)
 
-        if L is None:
-            L = self._multiple_of_L0_covering_topk(topk=topk)
-        assert topk <= L <= self.N,\
-            "Parameters are weird. Make sure topk<=L<=N:  topk={}, L={}, N={}".format(topk, L, self.N)
+        if method == "linear":
+            ids, dists = self.impl_cpp.query_linear(q_, topk, tids)
+        elif method == "ivf":
+            ids, dists = self.impl_cpp.query_ivf(q_, topk, tids, L)
 
-        if target_ids is None:
-            tids = np.array([], dtype=np.int64)
-            len_target_ids = self.N
-        else:
-            assert isinstance(target_ids, np.ndarray)
-            assert target_ids.dtype == np.int64
-            assert target_ids.ndim == 1
-            if sort_target_ids:
-                tids = np.sort(target_ids)
-            else:
-                tids = target_ids
-            len_target_ids = len(tids)
-        assert topk <= len_target_ids <= self.N, \
-            "Parameters are weird. Make sure topk<=len(target_ids)<=N:  "\
-            "topk={}, len(target_ids)={}, N={}".format(topk, len_target_ids, self.N)
+        return ids, dists.astype(np.float64)
 
-        if isinstance(self.fine_quantizer, nanopq.OPQ):
-            q_ = self.fine_quantizer.rotate(q)
-        elif isinstance(self.fine_quantizer, nanopq.PQ):
-            q_ = q
+    def query_batch(self, Q, topk=1, L=None, target_ids=None, sort_target_ids=True, method="auto"):
+        """Run :func:`query` for several query vectors at once, inside cpp without the Python loop.
+        For the linear scan, the PQ-codes are read once for each block of 8 queries. If there are enough
+        queries, they are processed in parallel. Otherwise, the scan over the PQ-codes is parallelized.
+        The parameters are shared among all queries. The result for each query is the same as that of
+        :func:`query`.
 
-        if method == "auto":
-            if self._use_linear(len_target_ids, L):
-                ids, dists = self.impl_cpp.query_linear(q_, topk, tids)
-            else:
-                ids, dists = self.impl_cpp.query_ivf(q_, topk, tids, L)
-        elif method == "linear":
-            ids, dists = self.impl_cpp.query_linear(q_, topk, tids)
+        Args:
+            Q (np.ndarray): The query vectors with the shape=(Nq, D) and dtype=np.float32.
+            topk (int): See :func:`query`.
+            L (int): See :func:`query`.
+            target_ids (np.ndarray): See :func:`query`. The same target identifiers are used for all queries.
+            sort_target_ids (bool): See :func:`query`.
+            method (str): See :func:`query`.
+
+        Returns:
+            (np.ndarray, np.ndarray):
+                The results (nearest items) of the search.
+                The first one is the identifiers of the items, with the shape=(Nq, topk) and dtype=int64.
+                The second one is the distances of the items to the queries, with the shape=(Nq, topk) and dtype=float64.
+                If less than ``topk`` items are found for a query, the rest are filled by -1 (ids) and inf (dists).
+
+        """
+        assert Q.ndim == 2
+        topk, L, tids, method = self._resolve_query_params(topk, L, target_ids, sort_target_ids, method)
+
+        Q_ = self._rotate(Q)  # Rotated by a single matmul for OPQ
+
+        if method == "linear":
+            ids, dists = self.impl_cpp.query_linear_batch(Q_, topk, tids)
         elif method == "ivf":
-            ids, dists = self.impl_cpp.query_ivf(q_, topk, tids, L)
+            ids, dists = self.impl_cpp.query_ivf_batch(Q_, topk, tids, L)
 
-        return np.array(ids, np.int64), np.array(dists)
+        return ids, dists.astype(np.float64)
 
     def clear(self):
         """Clear all data, i.e., (1) coarse_centers, (2) PQ-codes, (3) posting_lists, and (4) threshold function.
@@ -371,6 +380,33 @@ class Rii(object):
             print("_use_linear({S}, L={L0}): {use_linear}".format(
                 S=S, L0=self.L0, use_linear=use_linear))
 
+    def __reduce_ex__(self, protocol):
+        # With pickle protocol 5 (PEP 574), the codes, the coarse centers, and the posting lists are passed
+        # as pickle.PickleBuffer, so that they can be serialized out-of-band without copies, e.g.,
+        # pickle.dumps(e, protocol=5, buffer_callback=buffers.append). Otherwise, pickle the instance as usual.
+        # The other attributes (including those of subclasses) are restored as the usual state via __dict__.
+        if protocol < 5:
+            return super().__reduce_ex__(protocol)
+        _, verbose, coarse_centers, flattened_codes, offsets, ids = self.impl_cpp.__getstate__()
+        state = {k: v for k, v in self.__dict__.items() if k != "impl_cpp"}
+        return (_reconstruct_rii, (type(self), self.fine_quantizer.codewords, verbose,
+                                   pickle.PickleBuffer(coarse_centers), pickle.PickleBuffer(flattened_codes),
+                                   pickle.PickleBuffer(offsets), pickle.PickleBuffer(ids)),
+                state)
+
+    def _rotate(self, vecs):
+        # Rotate vector(s) if the fine quantizer is OPQ, so that they can be directly PQ-encoded
+        # by the codewords. If it is PQ, return vecs as is.
+        # All vectors are rotated by a single float32 matrix product (sgemm by BLAS). The rotation matrix is
+        # cast to float32 if needed, so that the result is a C-contiguous float32 array, which is passed to cpp
+        # without any conversion.
+        if isinstance(self.fine_quantizer, nanopq.OPQ):
+            assert vecs.dtype == np.float32
+            assert self.fine_quantizer.R is not None, "R must be set by fit() before rotate()"
+            R = self.fine_quantizer.R.astype(np.float32, copy=False)
+            return np.ascontiguousarray(vecs @ R)
+        return vecs
+
     def _multiple_of_L0_covering_topk(self, topk):
         # Given topk, decide a nice L (candidate length)
         # Currently, it returns a multiple of #avg_poslist,
@@ -387,6 +423,43 @@ class Rii(object):
         else:
             return False
 
+    def _resolve_query_params(self, topk, L, target_ids, sort_target_ids, method):
+        # Check and set the parameters for query() and query_batch().
+        # Return (topk, L, tids, method), where method is 'linear' or 'ivf'
+        assert 0 < self.N   # Make sure there are codes to be searched
+        assert 0 < self.nlist   # Make sure posting lists are available
+        assert method in ["auto", "linear", "ivf"]
+
+        if topk is None:
+            topk = self.N
+        assert 1 <= topk <= self.N
+
+        if L is None:
+            L = self._multiple_of_L0_covering_topk(topk=topk)
+        assert topk <= L <= self.N,\
+            "Parameters are weird. Make sure topk<=L<=N:  topk={}, L={}, N={}".format(topk, L, self.N)
+
+        if target_ids is None:
+            tids = np.array([], dtype=np.int64)
+            len_target_ids = self.N
+        else:
+            assert isinstance(target_ids, np.ndarray)
+            assert target_ids.dtype == np.int64
+            assert target_ids.ndim == 1
+            if sort_target_ids:
+                tids = np.sort(target_ids)
+            else:
+                tids = np.ascontiguousarray(target_ids)
+            len_target_ids = len(tids)
+        assert topk <= len_target_ids <= self.N, \
+            "Parameters are weird. Make sure topk<=len(target_ids)<=N:  "\
+            "topk={}, len(target_ids)={}, N={}".format(topk, len_target_ids, self.N)
+
+        if method == "auto":
+            method = "linear" if self._use_linear(len_target_ids, L) else "ivf"
+
+        return topk, L, tids, method
+
     def _resolve_update_posting_lists_flag(self, flag):
         # If flag == auto, return True or False depending on nlist.
         # Otherwise, return directly
@@ -400,6 +473,20 @@ class Rii(object):
             return flag
 
 
+def _reconstruct_rii(cls, codewords, verbose, coarse_centers, flattened_codes, offsets, ids):
+    # Create an instance of cls (Rii or its subclass) with the cpp-instance, given the items from Rii.__reduce_ex__.
+    # The last four items are buffers (e.g., PickleBuffer or bytes) of coarse_centers, flattened_codes,
+    # and the posting lists. The other attributes are set afterwards by pickle from the state.
+    e = cls.__new__(cls)
+    e.impl_cpp = main.RiiCpp.__new__(main.RiiCpp)
+    e.impl_cpp.__setstate__((codewords, verbose,
+                             np.frombuffer(coarse_centers, dtype=np.uint8),
+                             np.frombuffer(flattened_codes, dtype=np.uint8),
+                             np.frombuffer(offsets, dtype=np.int64),
+                             np.frombuffer(ids, dtype=np.int32)))
+    return e
+
+
 def estimate_best_threshold_function(e, queries):
     import time
     topk = 1  # We suppose topk does not affect the result, so use topk=1
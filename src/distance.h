@@ -16,7 +16,7 @@
 // These fast L2 squared distance codes (SSE and AVX) are from the Faiss library:
 // https://github.com/facebookresearch/faiss/blob/master/utils.cpp
 //
-// Based on them, AVX512 implementation is also prepared.
+// Based on them, AVX512 implementation is also prepared (with FMA and masked loads for the remainder).
 // But it doesn't seem drastically fast. Only slightly faster than AVX:
 // (runtime) REF >> SSE >= AVX ~ AVX512
 
@@ -114,6 +114,8 @@ static inline __m512 masked_read_16 (int d, const float *x)
 static const std::string g_simd_architecture = "avx512";
 
 // AVX512 implementation by Yusuke
+// D is processed by chunks of 16 floats, and the remainder (d < 16) is read by a masked load.
+// So any D is handled without falling back to AVX/SSE.
 float fvec_L2sqr (const float *x, const float *y, size_t d)
 {
     __m512 msum1 = _mm512_setzero_ps();
@@ -122,48 +124,26 @@ float fvec_L2sqr (const float *x, const float *y, size_t d)
         __m512 mx = _mm512_loadu_ps (x); x += 16;
         __m512 my = _mm512_loadu_ps (y); y += 16;
         const __m512 a_m_b1 = _mm512_sub_ps(mx, my);
-        //msum1 += a_m_b1 * a_m_b1;
-        msum1 = _mm512_add_ps(msum1, _mm512_mul_ps(a_m_b1, a_m_b1));
+        // msum1 += a_m_b1 * a_m_b1;
+        msum1 = _mm512_fmadd_ps(a_m_b1, a_m_b1, msum1);
         d -= 16;
     }
 
-    __m256 msum2 = _mm512_extractf32x8_ps(msum1, 1);
-    // msum2 += _mm512_extractf32x8_ps(msum1, 0);
-    msum2 = _mm256_add_ps(msum2, _mm512_extractf32x8_ps(msum1, 0));
-
-    while (d >= 8) {
-        __m256 mx = _mm256_loadu_ps (x); x += 8;
-        __m256 my = _mm256_loadu_ps (y); y += 8;
-        // const __m256 a_m_b1 = mx - my;
-        const __m256 a_m_b1 = _mm256_sub_ps(mx, my);
-        // msum2 += a_m_b1 * a_m_b1;
-        msum2 = _mm256_add_ps(msum2, _mm256_mul_ps(a_m_b1, a_m_b1));
-        d -= 8;
+    if (d > 0) {
+        const __mmask16 mask = (__mmask16) ((1U << d) - 1U);
+        __m512 mx = _mm512_maskz_loadu_ps (mask, x);
+        __m512 my = _mm512_maskz_loadu_ps (mask, y);
+        const __m512 a_m_b1 = _mm512_sub_ps(mx, my);
+        // msum1 += a_m_b1 * a_m_b1;
+        msum1 = _mm512_fmadd_ps(a_m_b1, a_m_b1, msum1);
     }
 
+    // Horizontal sum. _mm512_reduce_add_ps is not used because it triggers
+    // -Wmaybe-uninitialized inside avx512fintrin.h on GCC 12
+    __m256 msum2 = _mm512_extractf32x8_ps(msum1, 1);
+    msum2 = _mm256_add_ps(msum2, _mm512_extractf32x8_ps(msum1, 0));
     __m128 msum3 = _mm256_extractf128_ps(msum2, 1);
-    // msum3 += _mm256_extractf128_ps(msum2, 0);
     msum3 = _mm_add_ps(msum3, _mm256_extractf128_ps(msum2, 0));
-
-    if (d >= 4) {
-        __m128 mx = _mm_loadu_ps (x); x += 4;
-        __m128 my = _mm_loadu_ps (y); y += 4;
-        // const __m128 a_m_b1 = mx - my;
-        const __m128 a_m_b1 = _mm_sub_ps(mx, my);
-        // msum3 += a_m_b1 * a_m_b1;
-        msum3 = _mm_add_ps(msum3, _mm_mul_ps(a_m_b1, a_m_b1));
-        d -= 4;
-    }
-
-    if (d > 0) {
-        __m128 mx = masked_read (d, x);
-        __m128 my = masked_read (d, y);
-        // __m128 a_m_b1 = mx - my;
-        __m128 a_m_b1 = _mm_sub_ps(mx, my);
-        // msum3 += a_m_b1 * a_m_b1;
-        msum3 = _mm_add_ps(msum3, _mm_mul_ps(a_m_b1, a_m_b1));
-    }
-
     msum3 = _mm_hadd_ps (msum3, msum3);
     msum3 = _mm_hadd_ps (msum3, msum3);
     return  _mm_cvtss_f32 (msum3);
@@ -8,12 +8,54 @@
 namespace py = pybind11;
 
 namespace rii {
+
+// Copy std::vector <-> np.array at once (pybind11/stl.h converts them element by element via list)
+template <typename T>
+py::array_t<T> VectorToArray(const std::vector<T> &vec) {
+    return py::array_t<T>(vec.size(), vec.data());
+}
+
+template <typename T>
+std::vector<T> ArrayToVector(const py::handle &obj) {
+    const auto arr = py::array_t<T, py::array::c_style | py::array::forcecast>::ensure(obj);
+    return std::vector<T>(arr.data(), arr.data() + arr.size());
+}
+
+// (nlist, M) coarse centers as np.array
+py::array_t<unsigned char> CoarseCentersToArray(const RiiCpp &p) {
+    py::array_t<unsigned char> arr({p.GetNumList(), p.M_});
+    auto w = arr.mutable_unchecked<2>();
+    for (size_t no = 0; no < p.GetNumList(); ++no) {
+        for (size_t m = 0; m < p.M_; ++m) {
+            w(no, m) = p.coarse_centers_[no][m];
+        }
+    }
+    return arr;
+}
+
+// (M, Ks, Ds) codewords as np.array
+py::array_t<float> CodewordsToArray(const RiiCpp &p) {
+    size_t Ds = p.codewords_[0][0].size();
+    py::array_t<float> arr({p.M_, p.Ks_, Ds});
+    auto w = arr.mutable_unchecked<3>();
+    for (size_t m = 0; m < p.M_; ++m) {
+        for (size_t ks = 0; ks < p.Ks_; ++ks) {
+            for (size_t ds = 0; ds < Ds; ++ds) {
+                w(m, ks, ds) = p.codewords_[m][ks][ds];
+            }
+        }
+    }
+    return arr;
+}
+
 PYBIND11_MODULE(main, m) {
     py::class_<RiiCpp>(m, "RiiCpp")
         .def(py::init<>())  // required in pickle
         .def(py::init<py::array_t<float>, bool>())
         .def("reconfigure", &RiiCpp::Reconfigure)
         .def("add_codes", &RiiCpp::AddCodes)
+        .def("encode", &RiiCpp::Encode)
+        .def("add_vecs", &RiiCpp::AddVecs)
         .def("query_linear", &RiiCpp::QueryLinear,
              py::arg("query").noconvert(),  // Prohibit implicit data conversion
              py::arg("topk"),
@@ -25,30 +67,67 @@ PYBIND11_MODULE(main, m) {
              py::arg("target_ids").noconvert(),  // Prohibit implicit data conversion
              py::arg("L")
              )
+        .def("query_linear_batch", &RiiCpp::QueryLinearBatch,
+             py::arg("queries").noconvert(),  // Prohibit implicit data conversion
+             py::arg("topk"),
+             py::arg("target_ids").noconvert()  // Prohibit implicit data conversion
+             )
+        .def("query_ivf_batch", &RiiCpp::QueryIvfBatch,
+             py::arg("queries").noconvert(),  // Prohibit implicit data conversion
+             py::arg("topk"),
+             py::arg("target_ids").noconvert(),  // Prohibit implicit data conversion
+             py::arg("L")
+             )
         .def("clear", &RiiCpp::Clear)
         .def_readwrite("verbose", &RiiCpp::verbose_)
-        .def_readonly("coarse_centers", &RiiCpp::coarse_centers_)
-        .def_readonly("flattened_codes", &RiiCpp::flattened_codes_)
-        .def_readonly("posting_lists", &RiiCpp::posting_lists_)
+        .def_property_readonly("coarse_centers", &CoarseCentersToArray)
+        .def_property_readonly("flattened_codes", [](const RiiCpp &p){return VectorToArray(p.flattened_codes_);})
+        .def_property_readonly("posting_list_offsets", [](const RiiCpp &p){return VectorToArray(p.posting_lists_.CompactOffsets());})
+        .def_property_readonly("posting_list_ids", [](const RiiCpp &p){return VectorToArray(p.posting_lists_.CompactIds());})
         .def_property_readonly("N", &RiiCpp::GetN)
         .def_property_readonly("nlist", &RiiCpp::GetNumList)
         .def(py::pickle(
+            // All items except verbose are np.array, so that they are pickled as buffers
+            // (out-of-band with protocol 5) instead of element by element.
             [](const RiiCpp &p){
-                return py::make_tuple(p.codewords_, p.verbose_,
-                p.coarse_centers_, p.flattened_codes_, p.posting_lists_);
+                return py::make_tuple(CodewordsToArray(p), p.verbose_,
+                CoarseCentersToArray(p), VectorToArray(p.flattened_codes_),
+                VectorToArray(p.posting_lists_.CompactOffsets()), VectorToArray(p.posting_lists_.CompactIds()));
             },
             [](py::tuple t){
-                if (t.size() != 5) {
+                if (t.size() != 5 && t.size() != 6) {
                     throw std::runtime_error("Invalid state when reading pickled item");
                 }
-                RiiCpp p;
-                p.codewords_ = t[0].cast<std::vector<std::vector<std::vector<float>>>>();
-                p.M_ = p.codewords_.size();
-                p.Ks_ = p.codewords_[0].size();
+                // Older versions pickled codewords, coarse_centers, and flattened_codes as (nested) lists.
+                // Both are accepted, because they are read via np.array.
+                RiiCpp p(py::array_t<float, py::array::c_style | py::array::forcecast>::ensure(t[0]), false);
                 p.verbose_ = t[1].cast<bool>();
-                p.coarse_centers_ = t[2].cast<std::vector<std::vector<unsigned char>>>();
-                p.flattened_codes_ = t[3].cast<std::vector<unsigned char>>();
-                p.posting_lists_ = t[4].cast<std::vector<std::vector<int>>>();
+                const auto coarse_centers = ArrayToVector<unsigned char>(t[2]);
+                for (size_t i = 0; i < coarse_centers.size(); i += p.M_) {
+                    p.coarse_centers_.emplace_back(coarse_centers.begin() + i, coarse_centers.begin() + i + p.M_);
+                }
+                p.flattened_codes_ = ArrayToVector<unsigned char>(t[3]);
+                if (t.size() == 6) {
+                    p.posting_lists_ = PostingListsCSR(ArrayToVector<int64_t>(t[4]), ArrayToVector<int32_t>(t[5]));
+                } else {
+                    // Pickled by older versions, where posting lists are list of list
+                    auto posting_lists = t[4].cast<std::vector<std::vector<int>>>();
+                    std::vector<int64_t> offsets(1, 0);
+                    std::vector<int32_t> ids;
+                    for (const auto &posting_list : posting_lists) {
+                        ids.insert(ids.end(), posting_list.begin(), posting_list.end());
+                        offsets.push_back((int64_t) ids.size());
+                    }
+                    if (posting_lists.empty()) {
+                        offsets.clear();
+                    }
+                    p.posting_lists_ = PostingListsCSR(offsets, ids);
+                }
+                if (p.UseFastScan()) {
+                    p.UpdateFastScanCodes(0, p.GetN());
+                } else {
+                    p.UpdateCodesSoa(0, p.GetN());
+                }
                 return p;
             }
         ));
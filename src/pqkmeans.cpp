@@ -10,9 +10,9 @@ PQKMeans::PQKMeans(std::vector<std::vector<std::vector<float> > > codewords, int
 {
     assert(!codewords.empty() && !codewords[0].empty() && !codewords[0][0].empty());
     M_ = codewords.size(); // The number of subspace
-    std::size_t Ks = codewords[0].size();  // The number of codewords for each subspace
+    Ks_ = codewords[0].size();  // The number of codewords for each subspace
 
-    if (256 < Ks) {
+    if (256 < Ks_) {
         std::cerr << "Error. Ks is too large. "
                   << "Currently, we only support PQ code with Ks <= 256 "
                   << "so that each subspace is represented by unsigned char (8 bit)"
@@ -21,13 +21,12 @@ PQKMeans::PQKMeans(std::vector<std::vector<std::vector<float> > > codewords, int
     }
 
     // Compute distance-matrices among codewords
-    distance_matrices_among_codewords_.resize(
-                M_, std::vector<std::vector<float>>(Ks, std::vector<float>(Ks, 0)));
+    distance_matrices_among_codewords_.resize(M_ * Ks_ * Ks_, 0);
 
     for (std::size_t m = 0; m < M_; ++m) {
-        for (std::size_t k1 = 0; k1 < Ks; ++k1) {
-            for (std::size_t k2 = 0; k2 < Ks; ++k2) {
-                distance_matrices_among_codewords_[m][k1][k2] =
+        for (std::size_t k1 = 0; k1 < Ks_; ++k1) {
+            for (std::size_t k2 = 0; k2 < Ks_; ++k2) {
+                distance_matrices_among_codewords_[(m * Ks_ + k1) * Ks_ + k2] =
                         L2SquaredDistance(codewords[m][k1], codewords[m][k2]);
             }
         }
@@ -37,7 +36,12 @@ PQKMeans::PQKMeans(std::vector<std::vector<std::vector<float> > > codewords, int
 int PQKMeans::predict_one(const std::vector<unsigned char> &pyvector)
 {
     assert(pyvector.size() == M_);
-    std::pair<std::size_t, float> nearest_one = FindNearetCenterLinear(pyvector, centers_);
+    return predict_one(pyvector.data());
+}
+
+int PQKMeans::predict_one(const unsigned char *code)
+{
+    std::pair<std::size_t, float> nearest_one = FindNearetCenterLinear(code, centers_);
     return (int) nearest_one.first;
 }
 
@@ -88,7 +92,7 @@ void PQKMeans::fit(const std::vector<unsigned char> &pydata) {
 #pragma omp parallel for
         for(long long n_tmp = 0LL; n_tmp < static_cast<long long>(N); ++n_tmp) {
             std::size_t n = static_cast<std::size_t>(n_tmp);
-            std::pair<std::size_t, float> min_k_dist = FindNearetCenterLinear(NthCode(pydata, n), centers_old);
+            std::pair<std::size_t, float> min_k_dist = FindNearetCenterLinear(pydata.data() + n * M_, centers_old);
             assignments_[n] = (int) min_k_dist.first;
             errors[n] = min_k_dist.second;
         }
@@ -149,14 +153,14 @@ void PQKMeans::SetClusterCenters(const std::vector<std::vector<unsigned char>> &
 }
 
 
-float PQKMeans::SymmetricDistance(const std::vector<unsigned char> &code1,
-                                  const std::vector<unsigned char> &code2)
+float PQKMeans::SymmetricDistance(const unsigned char *code1,
+                                  const unsigned char *code2) const
 {
-    // assert(code1.size() == code2.size());
-    // assert(code1.size() == M_);
+    // Both code1 and code2 must be M-dim
+    const float *dm = distance_matrices_among_codewords_.data();
     float dist = 0;
     for (std::size_t m = 0; m < M_; ++m) {
-        dist += distance_matrices_among_codewords_[m][code1[m]][code2[m]];
+        dist += dm[(m * Ks_ + code1[m]) * Ks_ + code2[m]];
     }
     return dist;
 }
@@ -190,26 +194,18 @@ void PQKMeans::InitializeCentersByRandomPicking(const std::vector<unsigned char>
 
 }
 
-std::pair<std::size_t, float> PQKMeans::FindNearetCenterLinear(const std::vector<unsigned char> &query,
-                                                               const std::vector<std::vector<unsigned char> > &codes)
+std::pair<std::size_t, float> PQKMeans::FindNearetCenterLinear(const unsigned char *query,
+                                                               const std::vector<std::vector<unsigned char> > &codes) const
 {
-    std::vector<float> dists(codes.size());
-
-    // Compute a distance from a query to each code in parallel
-    long long sz = static_cast<long long>(codes.size());
-#pragma omp parallel for
-    for (long long i_tmp = 0; i_tmp < sz; ++i_tmp) {
-        std::size_t i = static_cast<std::size_t>(i_tmp);
-        dists[i] = SymmetricDistance(query, codes[i]);
-    }
-
-    // Just pick up the closest one
+    // Compute a distance from a query to each code, and just pick up the closest one.
+    // This is called inside parallelized loops over queries, so this loop itself is not parallelized.
     float min_dist = FLT_MAX;
     int min_i = -1;
     for (size_t i = 0, sz = codes.size(); i < sz; ++i) {
-        if (dists[i] < min_dist) {
+        float dist = SymmetricDistance(query, codes[i].data());
+        if (dist < min_dist) {
             min_i = static_cast<int>(i);
-            min_dist = dists[i];
+            min_dist = dist;
         }
     }
     assert(min_i != -1);
@@ -223,7 +219,7 @@ std::pair<std::size_t, float> PQKMeans::FindNearetCenterLinear(const std::vector
 std::vector<unsigned char> PQKMeans::ComputeCenterBySparseVoting(const std::vector<unsigned char> &codes, const std::vector<std::size_t> &selected_ids)
 {
     std::vector<unsigned char> average_code(M_);
-    std::size_t Ks = codewords_[0].size();  // The number of codewords for each subspace
+    std::size_t Ks = Ks_;
 
     for (std::size_t m = 0; m < M_; ++m) {
         // Scan the assigned codes, then create a freq-histogram
@@ -239,8 +235,9 @@ std::vector<unsigned char> PQKMeans::ComputeCenterBySparseVoting(const std::vect
             if (freq == 0) { // not assigned for k1. Skip it.
                 continue;
             }
+            const float *dm = distance_matrices_among_codewords_.data() + (m * Ks + k1) * Ks;
             for (std::size_t k2 = 0; k2 < Ks; ++k2) {
-                vote[k2] += (float) freq * distance_matrices_among_codewords_[m][k1][k2];
+                vote[k2] += (float) freq * dm[k2];
             }
         }
 
@@ -17,6 +17,7 @@ public:
     PQKMeans(std::vector<std::vector<std::vector<float>>> codewords, int K, int itr, bool verbose);
 
     int predict_one(const std::vector<unsigned char> &pyvector);
+    int predict_one(const unsigned char *code);  // code must be M-dim
     void fit(const std::vector<unsigned char> &pydata);  // pydata is a long array. pydata.size == N * M
 
     const std::vector<int> GetAssignments();
@@ -33,17 +34,19 @@ private:
     int K_;
     int iteration_;
     std::size_t M_; // the number of subspace
+    std::size_t Ks_; // the number of codewords for each subspace
     bool verbose_;
 
     std::vector<std::vector<unsigned char>> centers_;  // centers for clustering.
     std::vector<int> assignments_;  // assignement for each intput vector
 
 
-    // [m][k1][k2]: m-th subspace, the L2 squared distance between k1-th and k2-th codewords
-    std::vector<std::vector<std::vector<float>>> distance_matrices_among_codewords_;
+    // [m * Ks * Ks + k1 * Ks + k2]: m-th subspace, the L2 squared distance between k1-th and k2-th codewords.
+    // This is flattened to a contiguous (M, Ks, Ks) array so that the symmetric distance is M table lookups.
+    std::vector<float> distance_matrices_among_codewords_;
 
-    float SymmetricDistance(const std::vector<unsigned char> &code1,
-                            const std::vector<unsigned char> &code2);
+    float SymmetricDistance(const unsigned char *code1,
+                            const unsigned char *code2) const;
 
     float L2SquaredDistance(const std::vector<float> &vec1,
                             const std::vector<float> &vec2);
@@ -53,8 +56,8 @@ private:
                                           std::vector<std::vector<unsigned char>> *centers_);
 
     // Linear search by Symmetric Distance computation. Return the best one (id, distance)
-    std::pair<std::size_t, float> FindNearetCenterLinear(const std::vector<unsigned char> &query,
-                                                         const std::vector<std::vector<unsigned char>> &codes);
+    std::pair<std::size_t, float> FindNearetCenterLinear(const unsigned char *query,
+                                                         const std::vector<std::vector<unsigned char>> &codes) const;
 
     // Compute a new cluster center from assigned codes. codes: All N codes. selected_ids: selected assigned ids.
     // e.g., If selected_ids=[4, 25, 13], then codes[4], codes[25], and codes[13] are averaged by the proposed sparse voting scheme.
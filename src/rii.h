@@ -3,6 +3,13 @@
 
 #include <iostream>
 #include <cassert>
+#include <cstdint>
+#include <limits>
+#include <memory>
+#include <stdexcept>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 #include "./pqkmeans.h"
 #include "./distance.h"
 
@@ -35,6 +42,157 @@ struct DistanceTable{
     std::vector<float> data_;
 };
 
+struct PostingListsCSR{
+    // Posting lists in the CSR (compressed sparse row) format.
+    // The IDs in no-th posting list are ids[offsets[no]], ..., ids[offsets[no] + lengths[no] - 1].
+    // All IDs are stored in a single contiguous array so that posting lists are scanned sequentially.
+    // Each list can have spare room up to offsets[no + 1], where new IDs are appended in place.
+    PostingListsCSR() {}
+    PostingListsCSR(const std::vector<int64_t> &offsets_, const std::vector<int32_t> &ids_)
+        : offsets(offsets_), lengths(offsets_.empty() ? 0 : offsets_.size() - 1), ids(ids_) {
+        // From the arrays without spare room, e.g., CompactOffsets() and CompactIds()
+        for (size_t no = 0; no < lengths.size(); ++no) {
+            lengths[no] = offsets[no + 1] - offsets[no];
+        }
+    }
+    size_t Size() const {return lengths.size();}
+    size_t Length(size_t no) const {return (size_t) lengths[no];}
+    const int32_t *Begin(size_t no) const {return ids.data() + offsets[no];}
+    const int32_t *End(size_t no) const {return ids.data() + offsets[no] + lengths[no];}
+    std::vector<int64_t> CompactOffsets() const {  // offsets without spare room
+        std::vector<int64_t> ret(offsets.empty() ? 0 : Size() + 1, 0);
+        for (size_t no = 0; no < Size(); ++no) {
+            ret[no + 1] = ret[no] + lengths[no];
+        }
+        return ret;
+    }
+    std::vector<int32_t> CompactIds() const {  // ids without spare room
+        std::vector<int32_t> ret;
+        ret.reserve(ids.size());
+        for (size_t no = 0; no < Size(); ++no) {
+            ret.insert(ret.end(), Begin(no), End(no));
+        }
+        return ret;
+    }
+    std::vector<int64_t> offsets;  // (NumList + 1)
+    std::vector<int64_t> lengths;  // (NumList)
+    std::vector<int32_t> ids;  // (offsets[NumList]) All IDs (N if all codes are assigned) and the spare room
+};
+
+// When the posting lists are rebuilt, each list gets spare room for (its length) / g_posting_list_spare_divisor + 1 IDs.
+// Until a list is full, small additions (e.g., add() of a single vector) are appended in place in O(batch size),
+// instead of rebuilding all posting lists in O(N). The spare room costs 4 / g_posting_list_spare_divisor bytes per code.
+static const size_t g_posting_list_spare_divisor = 8;
+
+struct QuantizedDistanceTable{
+    // Helper structure. 8-bit version of DistanceTable.
+    // dtable.GetVal(m, ks) is approximated by bias[m] + scale * qdtable.GetVal(m, ks),
+    // where the scale is shared among subspaces so that quantized values can be summed up directly.
+    // Because the values are truncated, the true distance of a code with the quantized
+    // distance q lies in [sum(bias) + scale * q, sum(bias) + scale * (q + M)).
+    QuantizedDistanceTable() : bias_sum_(0), scale_(0) {}
+    QuantizedDistanceTable(const DistanceTable &dtable) : Ks_(dtable.Ks_), data_(dtable.data_.size()), bias_sum_(0) {
+        size_t M = dtable.data_.size() / Ks_;
+        std::vector<float> bias(M);
+        float span = 0;
+        for (size_t m = 0; m < M; ++m) {
+            const auto begin = dtable.data_.begin() + m * Ks_;
+            const auto minmax = std::minmax_element(begin, begin + Ks_);
+            bias[m] = *minmax.first;
+            bias_sum_ += bias[m];
+            span = std::max(span, *minmax.second - *minmax.first);
+        }
+        scale_ = span / 255.0;
+        float inv_scale = (0 < span) ? 255.0f / span : 0.0f;
+        for (size_t m = 0; m < M; ++m) {
+            for (size_t ks = 0; ks < Ks_; ++ks) {
+                float q = (dtable.GetVal(m, ks) - bias[m]) * inv_scale;
+                data_[m * Ks_ + ks] = (unsigned char) std::min(q, 255.0f);
+            }
+        }
+    }
+    unsigned char GetVal(size_t m, size_t ks) const {
+        return data_[m * Ks_ + ks];
+    }
+    uint32_t Margin(uint32_t qk) const {
+        // Given the k-th smallest quantized distance qk, the true top-k are in the codes with q <= qk + Margin(qk).
+        // Besides the truncation (M), the float sums in ADist have errors up to about M * epsilon * (distance)
+        // for both the k-th code and a candidate. If sum(bias) is much larger than scale (e.g., the query is far
+        // from the data), this error is more than one quantization step, so it is converted into units of q as well.
+        size_t M = data_.size() / Ks_;
+        if (scale_ <= 0) {  // All codes have the same quantized distance
+            return UINT16_MAX;
+        }
+        double dist = bias_sum_ + scale_ * ((double) qk + M + 1);
+        double slack = 2.0 * M * std::numeric_limits<float>::epsilon() * dist / scale_;
+        slack = std::max(1.0, std::ceil(slack));  // At least 1 for the rounding of the quantization
+        return (uint32_t) std::min((double) M + slack, (double) UINT16_MAX);
+    }
+    size_t Ks_;
+    std::vector<unsigned char> data_;
+    double bias_sum_;  // sum(bias)
+    double scale_;
+};
+
+// Keep the top-k (smallest distances) of scores, sorted. Ties are broken by ids, so the result does not depend on
+// the order of scores. For up to g_topk_heap_threshold scores, they are selected by nth_element (linear time)
+// and only the top-k are sorted. For more scores, partial_sort (a heap of size k) is used.
+static const size_t g_topk_heap_threshold = 1 << 16;
+
+inline void SelectTopk(std::vector<std::pair<size_t, float>> &scores, size_t topk)
+{
+    auto comp = [](const std::pair<size_t, float> &a, const std::pair<size_t, float> &b) {
+        return a.second < b.second || (a.second == b.second && a.first < b.first);
+    };
+    topk = std::min(topk, scores.size());
+    if (scores.size() <= g_topk_heap_threshold) {
+        if (topk < scores.size()) {
+            std::nth_element(scores.begin(), scores.begin() + topk, scores.end(), comp);
+        }
+        std::sort(scores.begin(), scores.begin() + topk, comp);
+    } else {
+        std::partial_sort(scores.begin(), scores.begin() + topk, scores.end(), comp);
+    }
+    scores.resize(topk);
+    scores.shrink_to_fit();
+}
+
+// The number of threads used by the next parallel region (1 if OpenMP is not available)
+inline size_t NumThreads()
+{
+#ifdef _OPENMP
+    return (size_t) omp_get_max_threads();
+#else
+    return 1;
+#endif
+}
+
+// Vectors are encoded by blocks of this size. A block of sub-vectors (e.g., 64 * 16 floats = 4KB)
+// and the codewords of a subspace (e.g., 256 * 16 floats = 16KB) fit in L1 cache together.
+static const size_t g_encode_block_size = 64;
+
+// In the scans, the PQ-code to be read this number of iterations later is prefetched.
+// For M=20, this is about 512 bytes ahead in a sequential scan.
+static const size_t g_prefetch_distance = 24;
+
+// In the batch linear search, queries are processed by blocks of this size, where
+// each PQ-code is read once and compared with all queries in the block.
+static const size_t g_query_block_size = 8;
+
+// In the IVF search, a wave of posting lists is scanned in parallel only if it gives at least this number
+// of candidates to be evaluated. Smaller waves are not worth the fork/join of threads, so the lists are
+// traversed one by one as usual.
+static const size_t g_ivf_parallel_min_length = 4096;
+
+// The fast scan over 4-bit PQ codes (Ks <= 16) performs 32 table lookups at once by PSHUFB on AVX2.
+// Without AVX2, the usual linear scan is used.
+// See "Quicker ADC" [André+, TPAMI 2019] and IndexPQFastScan in Faiss.
+#if defined(__AVX2__)
+static const bool g_fastscan_supported = true;
+#else
+static const bool g_fastscan_supported = false;
+#endif
+
 
 
 class RiiCpp {
@@ -46,23 +204,62 @@ public:
     //void SetCodewords(const py::array_t<float> &codewords);  // This should be called first
     void Reconfigure(int nlist, int iter);
     void AddCodes(const py::array_t<unsigned char> &codes, bool update_flag);
-
-    // The default integers of Python is int64 (long long), so the type of target_ids is long long
-    std::pair<std::vector<size_t>, std::vector<float>> QueryLinear(const py::array_t<float> &query,
-                                                                int topk,
-                                                                const py::array_t<long long> &target_ids) const;
-    std::pair<std::vector<size_t>, std::vector<float>> QueryIvf(const py::array_t<float> &query,
-                                                             int topk,
-                                                             const py::array_t<long long> &target_ids,
-                                                             int L) const;
+    void AddVecs(const py::array_t<float, py::array::c_style | py::array::forcecast> &vecs, bool update_flag);
+    py::array_t<unsigned char> Encode(const py::array_t<float, py::array::c_style | py::array::forcecast> &vecs) const;
+
+    // The default integers of Python is int64 (long long), so the type of target_ids is long long.
+    // target_ids is read directly from the buffer of np.array (no copy), and
+    // the results are returned as np.array (ids with int64 and dists with float32).
+    std::pair<py::array_t<long long>, py::array_t<float>> QueryLinear(const py::array_t<float, py::array::c_style> &query,
+                                                                      int topk,
+                                                                      const py::array_t<long long, py::array::c_style> &target_ids) const;
+    std::pair<py::array_t<long long>, py::array_t<float>> QueryIvf(const py::array_t<float, py::array::c_style> &query,
+                                                                   int topk,
+                                                                   const py::array_t<long long, py::array::c_style> &target_ids,
+                                                                   int L) const;
+    // Batch versions. queries has shape=(Nq, D), and the results have shape=(Nq, topk).
+    // Each query is processed in parallel.
+    std::pair<py::array_t<long long>, py::array_t<float>> QueryLinearBatch(const py::array_t<float, py::array::c_style> &queries,
+                                                                           int topk,
+                                                                           const py::array_t<long long, py::array::c_style> &target_ids) const;
+    std::pair<py::array_t<long long>, py::array_t<float>> QueryIvfBatch(const py::array_t<float, py::array::c_style> &queries,
+                                                                        int topk,
+                                                                        const py::array_t<long long, py::array::c_style> &target_ids,
+                                                                        int L) const;
     void Clear();
 
     // ===== Functions that would not be called from Python (Used inside c++) =====
     void UpdatePostingLists(size_t start, size_t num);
-    DistanceTable DTable(const py::array_t<float> &vec) const;
+    void AppendToPostingLists(size_t start, const std::vector<size_t> &assign);
+    void UpdateCodewordsSoa();
+    void EncodeVecs(const float *vecs, size_t N, unsigned char *codes) const;
+    void EncodeBlock(const float *vecs, size_t nb, unsigned char *codes) const;
+    unsigned char EncodeSubvector(const float *subvec, size_t m) const;
+    void UpdateFastScanCodes(size_t start, size_t num);
+    void UpdateCodesSoa(size_t start, size_t num);
+    bool UseFastScan() const {return g_fastscan_supported && Ks_ <= 16;}
+    void PrefetchCode(size_t n) const;
+    std::vector<std::pair<size_t, float>> FastScanCandidates(const DistanceTable &dtable, int topk) const;
+    std::vector<std::pair<size_t, float>> QuantizedScanCandidates(const DistanceTable &dtable, int topk,
+                                                                  const long long *tids, size_t S) const;
+    std::vector<uint16_t> QuantizedScanSoa(const QuantizedDistanceTable &qdtable) const;
+    std::vector<std::vector<std::pair<size_t, float>>> QuantizedScanCandidates(const std::vector<DistanceTable> &dtables, int topk,
+                                                                               const long long *tids, size_t S) const;
+    std::vector<std::pair<size_t, float>> RerankQuantized(const DistanceTable &dtable,
+                                                          const QuantizedDistanceTable &qdtable,
+                                                          const std::vector<uint16_t> &qdists,
+                                                          const long long *tids,
+                                                          int topk) const;
+    // Search for a query (D-dim). tids (S-dim, sorted) are the target ids. If S=0, all items are the targets
+    std::vector<std::pair<size_t, float>> SearchLinear(const float *query, int topk, const long long *tids, size_t S) const;
+    std::vector<std::pair<size_t, float>> SearchIvf(const float *query, int topk, const long long *tids, size_t S, int L) const;
+    DistanceTable DTable(const float *vec) const;  // vec must be D-dim
     float ADist(const DistanceTable &dtable, const std::vector<unsigned char> &code) const;
     float ADist(const DistanceTable &dtable, const std::vector<unsigned char> &flattened_codes, size_t n) const;
-    std::pair<std::vector<size_t>, std::vector<float>> PairVectorToVectorPair(const std::vector<std::pair<size_t, float>> &pair_vec) const;
+    float ADist(const DistanceTable &dtable, const unsigned char *code) const;
+    std::pair<py::array_t<long long>, py::array_t<float>> PairVectorToArrayPair(const std::vector<std::pair<size_t, float>> &pair_vec) const;
+    std::pair<py::array_t<long long>, py::array_t<float>> PairVectorsToArrayPair(const std::vector<std::vector<std::pair<size_t, float>>> &pair_vecs,
+                                                                                 int topk) const;
 
     // Property getter
     size_t GetN() const {return flattened_codes_.size() / M_;}
@@ -77,9 +274,16 @@ public:
     size_t M_, Ks_;
     bool verbose_;
     std::vector<std::vector<std::vector<float>>> codewords_;  // (M, Ks, Ds)
+    std::vector<float> codewords_soa_;  // (M, Ds, Ks) Transposed codewords, used for encoding
     std::vector<std::vector<unsigned char>> coarse_centers_;  // (NumList, M)
     std::vector<unsigned char> flattened_codes_;  // (N, M) PQ codes are flattened to N * M long array
-    std::vector<std::vector<int>> posting_lists_;  // (NumList, any)
+    PostingListsCSR posting_lists_;  // NumList posting lists
+    // (ceil(N/32), ceil(M/2), 32) Codes for the fast scan, used only if UseFastScan().
+    // For each block of 32 codes, two 4-bit sub-codes (m=2i and m=2i+1) are packed in a byte.
+    std::vector<unsigned char> fastscan_codes_;
+    // (ceil(N/32), M, 32) Codes for the linear scan, used only if !UseFastScan().
+    // For each block of 32 codes, the m-th sub-codes of the 32 codes are contiguous.
+    std::vector<unsigned char> codes_soa_;
 };
 
 
@@ -98,6 +302,7 @@ RiiCpp::RiiCpp(const py::array_t<float> &codewords, bool verbose)
             }
         }
     }
+    UpdateCodewordsSoa();
 
     if (verbose_) {
         // Check which SIMD functions are used. See distance.h for this global variable.
@@ -147,11 +352,7 @@ void RiiCpp::Reconfigure(int nlist, int iter)
 
     // ===== (4) Update posting lists =====
     if (verbose_) {std::cout << "Start to update posting lists" << std::endl;}
-    posting_lists_.clear();
-    posting_lists_.resize(nlist);
-    for (auto &posting_list : posting_lists_) {
-        posting_list.reserve(GetN() / nlist);  // Roughly malloc
-    }
+    posting_lists_ = PostingListsCSR(std::vector<int64_t>(nlist + 1, 0), {});  // nlist empty posting lists
     UpdatePostingLists(0, GetN());
 }
 
@@ -164,9 +365,8 @@ void RiiCpp::AddCodes(const py::array_t<unsigned char> &codes, bool update_flag)
     // of (2) you've decided to call reconfigure() manually after add()
 
     if (update_flag && coarse_centers_.empty()) {
-        std::cerr << "Error. reconfigure() must be called before running add(vecs=X, update_posting_lists=True)."
-                  << "If this is the first addition, please call add_configure(vecs=X)" << std::endl;
-        throw;
+        throw std::runtime_error("reconfigure() must be called before running add(vecs=X, update_posting_lists=True). "
+                                 "If this is the first addition, please call add_configure(vecs=X)");
     }
 
     // ===== (1) Add codes to flattened_codes =====
@@ -184,6 +384,11 @@ void RiiCpp::AddCodes(const py::array_t<unsigned char> &codes, bool update_flag)
         std::cout << N << " new vectors are added." << std::endl;
         std::cout << "Total number of codes is " << GetN() << std::endl;
     }
+    if (UseFastScan()) {
+        UpdateFastScanCodes(N0, N);
+    } else {
+        UpdateCodesSoa(N0, N);
+    }
 
     // ===== (2) Update posting lists =====
     if (update_flag) {
@@ -192,63 +397,200 @@ void RiiCpp::AddCodes(const py::array_t<unsigned char> &codes, bool update_flag)
     }
 }
 
-std::pair<std::vector<size_t>, std::vector<float> > RiiCpp::QueryLinear(const py::array_t<float> &query,
-                                                                        int topk,
-                                                                        const py::array_t<long long> &target_ids) const
+void RiiCpp::AddVecs(const py::array_t<float, py::array::c_style | py::array::forcecast> &vecs, bool update_flag)
 {
-    const auto &tids = target_ids.unchecked<1>(); // target_ids must have ndim = 1; can be non-writeable
-    size_t S = tids.shape(0);  // The number of target_ids. It might be 0 if not specified.
+    // This is the same as AddCodes(Encode(vecs), update_flag), but done in a single pass over vecs:
+    // each vector is PQ-encoded and, if update_flag=true, the new code is assigned to its nearest coarse center
+    // right away while it is still in cache. No intermediate codes array is created.
 
-    assert((size_t) topk <= GetN());
+    if (update_flag && coarse_centers_.empty()) {
+        throw std::runtime_error("reconfigure() must be called before running add(vecs=X, update_posting_lists=True). "
+                                 "If this is the first addition, please call add_configure(vecs=X)");
+    }
 
-    // ===== (1) Create dtable =====
-    DistanceTable dtable = DTable(query);
+    const auto &r = vecs.unchecked<2>();  // vecs must have ndim=2
+    size_t N = (size_t) r.shape(0);
+    size_t Ds = codewords_[0][0].size();
+    assert((size_t) r.shape(1) == M_ * Ds);
+    size_t N0 = GetN();
+    flattened_codes_.resize((N0 + N) * M_);
 
-    // ===== (2) Run PQ linear search =====
-    // [todo] Can be SIMDized?
-    std::vector<std::pair<size_t, float>> scores;
-    if (S == 0) {  // No target ids
-        size_t N = GetN();
-        scores.resize(N);
+    // A dummy pqkmeans class for computing Symmetric Distance, only if the posting lists are updated
+    std::unique_ptr<pqkmeans::PQKMeans> clustering_instance;
+    if (update_flag) {
+        clustering_instance.reset(new pqkmeans::PQKMeans(codewords_, (int) GetNumList(), 0, true));
+        clustering_instance->SetClusterCenters(coarse_centers_);
+    }
+    std::vector<size_t> assign(update_flag ? N : 0);
+
+    // ===== (1) Encode each block of vectors, and (2) find the nearest coarse center of each new code =====
+    const size_t B = g_encode_block_size;
 #pragma omp parallel for
-        for (long long n_tmp = 0LL; n_tmp < static_cast<long long>(N); ++n_tmp) {
-            size_t n = static_cast<size_t>(n_tmp);
-            scores[n] = {n, ADist(dtable, flattened_codes_, n)};
+    for (long long b_tmp = 0LL; b_tmp < static_cast<long long>((N + B - 1) / B); ++b_tmp) {
+        size_t n0 = static_cast<size_t>(b_tmp) * B;
+        size_t nb = std::min(B, N - n0);
+        EncodeBlock(r.data(n0, 0), nb, flattened_codes_.data() + (N0 + n0) * M_);
+        if (update_flag) {
+            for (size_t n = n0; n < n0 + nb; ++n) {
+                assign[n] = clustering_instance->predict_one(flattened_codes_.data() + (N0 + n) * M_);
+            }
         }
-    } else {  // Target ids are specified
-        assert((size_t) topk <= S);
-        assert(S <= GetN());
-        scores.resize(S);
+    }
+    if (verbose_) {
+        std::cout << N << " new vectors are added." << std::endl;
+        std::cout << "Total number of codes is " << GetN() << std::endl;
+    }
+    if (UseFastScan()) {
+        UpdateFastScanCodes(N0, N);
+    } else {
+        UpdateCodesSoa(N0, N);
+    }
+
+    // ===== (3) Update posting lists =====
+    if (update_flag) {
+        AppendToPostingLists(N0, assign);
+    }
+}
+
+py::array_t<unsigned char> RiiCpp::Encode(const py::array_t<float, py::array::c_style | py::array::forcecast> &vecs) const
+{
+    // Encode vectors (N, D) into PQ-codes (N, M). This is equivalent to nanopq.PQ.encode
+    // (the results can differ only if two codewords are tied up to rounding errors).
+    const auto &r = vecs.unchecked<2>();  // vecs must have ndim=2
+    size_t N = (size_t) r.shape(0);
+    size_t Ds = codewords_[0][0].size();
+    assert((size_t) r.shape(1) == M_ * Ds);
+
+    py::array_t<unsigned char> codes({N, M_});
+    EncodeVecs(r.data(0, 0), N, codes.mutable_data());
+    return codes;
+}
+
+std::pair<py::array_t<long long>, py::array_t<float>> RiiCpp::QueryLinear(const py::array_t<float, py::array::c_style> &query,
+                                                                          int topk,
+                                                                          const py::array_t<long long, py::array::c_style> &target_ids) const
+{
+    assert(query.ndim() == 1 && target_ids.ndim() == 1);
+    // Read the buffers directly. The number of target_ids (S) might be 0 if not specified.
+    // The search runs without the GIL, and the GIL is held again to create the result arrays.
+    std::vector<std::pair<size_t, float>> result;
+    {
+        py::gil_scoped_release release;
+        result = SearchLinear(query.data(), topk, target_ids.data(), (size_t) target_ids.shape(0));
+    }
+    return PairVectorToArrayPair(result);
+}
+
+std::pair<py::array_t<long long>, py::array_t<float>> RiiCpp::QueryIvf(const py::array_t<float, py::array::c_style> &query,
+                                                                       int topk,
+                                                                       const py::array_t<long long, py::array::c_style> &target_ids,
+                                                                       int L) const
+{
+    assert(query.ndim() == 1 && target_ids.ndim() == 1);
+    std::vector<std::pair<size_t, float>> result;
+    {
+        py::gil_scoped_release release;
+        result = SearchIvf(query.data(), topk, target_ids.data(), (size_t) target_ids.shape(0), L);
+    }
+    return PairVectorToArrayPair(result);
+}
+
+std::pair<py::array_t<long long>, py::array_t<float>> RiiCpp::QueryLinearBatch(const py::array_t<float, py::array::c_style> &queries,
+                                                                               int topk,
+                                                                               const py::array_t<long long, py::array::c_style> &target_ids) const
+{
+    assert(queries.ndim() == 2 && target_ids.ndim() == 1);
+    size_t Nq = (size_t) queries.shape(0);
+    size_t D = (size_t) queries.shape(1);
+    const float *qs = queries.data();
+    const long long *tids = target_ids.data();
+    size_t S = (size_t) target_ids.shape(0);
+    std::vector<std::vector<std::pair<size_t, float>>> results(Nq);
+    {
+        py::gil_scoped_release release;
+        if (S == 0 && UseFastScan()) {
+            // The fast scan already reads 32 codes at once for each query
+#pragma omp parallel for
+            for (long long q_tmp = 0LL; q_tmp < static_cast<long long>(Nq); ++q_tmp) {
+                size_t q = static_cast<size_t>(q_tmp);
+                results[q] = SearchLinear(qs + q * D, topk, tids, S);
+            }
+        } else {
+            // Otherwise, the codes are scanned once for each block of queries
+            assert((size_t) topk <= GetN());
+            assert(S == 0 || (size_t) topk <= S);
+            // If there are fewer blocks than threads, the blocks are processed one by one and
+            // the scan over the codes inside QuantizedScanCandidates runs in parallel instead.
+            const size_t B = g_query_block_size;
+            size_t num_block = (Nq + B - 1) / B;
+#pragma omp parallel for if(NumThreads() <= num_block)
+            for (long long b_tmp = 0LL; b_tmp < static_cast<long long>(num_block); ++b_tmp) {
+                size_t q0 = static_cast<size_t>(b_tmp) * B;
+                std::vector<DistanceTable> dtables;
+                for (size_t q = q0; q < std::min(q0 + B, Nq); ++q) {
+                    dtables.push_back(DTable(qs + q * D));
+                }
+                auto scores = QuantizedScanCandidates(dtables, topk, tids, S);
+                for (size_t j = 0; j < scores.size(); ++j) {
+                    SelectTopk(scores[j], (size_t) topk);
+                    results[q0 + j] = std::move(scores[j]);
+                }
+            }
+        }
+    }
+    return PairVectorsToArrayPair(results, topk);
+}
+
+std::pair<py::array_t<long long>, py::array_t<float>> RiiCpp::QueryIvfBatch(const py::array_t<float, py::array::c_style> &queries,
+                                                                            int topk,
+                                                                            const py::array_t<long long, py::array::c_style> &target_ids,
+                                                                            int L) const
+{
+    assert(queries.ndim() == 2 && target_ids.ndim() == 1);
+    size_t Nq = (size_t) queries.shape(0);
+    size_t D = (size_t) queries.shape(1);
+    const float *qs = queries.data();
+    const long long *tids = target_ids.data();
+    size_t S = (size_t) target_ids.shape(0);
+    std::vector<std::vector<std::pair<size_t, float>>> results(Nq);
+    {
+        py::gil_scoped_release release;
 #pragma omp parallel for
-        for (long long s_tmp = 0LL; s_tmp < static_cast<long long>(S); ++s_tmp) {
-            size_t s = static_cast<size_t>(s_tmp);
-            size_t tid = static_cast<size_t>(tids(s));
-            scores[s] = {tid, ADist(dtable, flattened_codes_, tid)};
+        for (long long q_tmp = 0LL; q_tmp < static_cast<long long>(Nq); ++q_tmp) {
+            size_t q = static_cast<size_t>(q_tmp);
+            results[q] = SearchIvf(qs + q * D, topk, tids, S, L);
         }
     }
+    return PairVectorsToArrayPair(results, topk);
+}
 
+std::vector<std::pair<size_t, float>> RiiCpp::SearchLinear(const float *query, int topk, const long long *tids, size_t S) const
+{
+    assert((size_t) topk <= GetN());
 
+    // ===== (1) Create dtable =====
+    DistanceTable dtable = DTable(query);
+
+    // ===== (2) Run PQ linear search =====
+    // The scan runs with 8-bit distance tables. Only the candidates that can be in the top-k
+    // are evaluated with the float dtable, so the result is the same as the scan with the float dtable.
+    std::vector<std::pair<size_t, float>> scores;
+    if (S == 0 && UseFastScan()) {  // No target ids. Candidates are selected by the fast scan
+        scores = FastScanCandidates(dtable, topk);
+    } else {  // If S != 0, target ids are specified
+        assert(S == 0 || (size_t) topk <= S);
+        assert(S <= GetN());
+        scores = QuantizedScanCandidates(dtable, topk, tids, S);
+    }
 
     // ===== (3) Sort them =====
-    // [todo] Can be parallelized?
-    std::partial_sort(scores.begin(), scores.begin() + topk, scores.end(),
-                      [](const std::pair<size_t, float> &a, const std::pair<size_t, float> &b){return a.second < b.second;});
-    scores.resize(topk);
-    scores.shrink_to_fit();
+    SelectTopk(scores, (size_t) topk);
 
-    // ===== (4) Return the result, in the form of pair<vec, vec> =====
-    // Note that this returns two lists, not np.array
-    return PairVectorToVectorPair(scores);
+    return scores;
 }
 
-std::pair<std::vector<size_t>, std::vector<float> > RiiCpp::QueryIvf(const py::array_t<float> &query,
-                                                                     int topk,
-                                                                     const py::array_t<long long> &target_ids,
-                                                                     int L) const
+std::vector<std::pair<size_t, float>> RiiCpp::SearchIvf(const float *query, int topk, const long long *tids, size_t S, int L) const
 {
-    const auto &tids = target_ids.unchecked<1>(); // target_ids must have ndim = 1 with non-writeable
-    size_t S = tids.shape(0);  // The number of target_ids. It might be 0 if not specified.
-
     assert((size_t) topk <= GetN());
     assert(topk <= L && (size_t) L <= GetN());
 
@@ -280,56 +622,100 @@ std::pair<std::vector<size_t>, std::vector<float> > RiiCpp::QueryIvf(const py::a
                       [](const std::pair<size_t, float> &a, const std::pair<size_t, float> &b){return a.second < b.second;});
 
     // ===== (4) Traverse posting list =====
+    // Posting lists are scanned in parallel, by waves of (the number of threads) lists. The candidates of
+    // the lists in a wave are then appended in the order of the coarse ranking, so the result is exactly
+    // the same as that of the sequential traversal. Only the lists after the termination in the last wave are wasted.
+    // If a wave is too small (see g_ivf_parallel_min_length), only a single list is scanned sequentially instead.
+    size_t num_wave = 1;
+#ifdef _OPENMP
+    if (!omp_in_parallel()) {  // e.g., query_ivf_batch already runs in parallel over queries
+        num_wave = (size_t) omp_get_max_threads();
+    }
+#endif
     std::vector<std::pair<size_t, float>> scores;
     scores.reserve(L);
-    int coarse_cnt = 0;
-    for (const auto &score_coarse : scores_coarse) {
-        size_t no = score_coarse.first;
-        coarse_cnt++;
-
-        // [todo] This loop can be parallelized
-        for (const auto &n : posting_lists_[no]) {
-            // ===== (5) If id is not included in target_ids, skip. =====
-            // Note that if S==0 (target is all), then evaluate all IDs
-            if (S != 0 && !std::binary_search(target_ids.data(), target_ids.data() + S, static_cast<long long>(n))) {
-                continue;
+    std::vector<std::vector<std::pair<size_t, float>>> wave_scores(num_wave);  // Buffers are reused among waves
+    size_t coarse_cnt = 0;
+    while (coarse_cnt < nlist) {
+        // The wave does not go over the w-th list, where the termination is checked
+        size_t wave_end = std::min(coarse_cnt + num_wave, (coarse_cnt < w) ? w : nlist);
+        size_t remain = (size_t) L - scores.size();  // No list needs to give more candidates than this
+        if (1 < num_wave) {
+            size_t wave_length = 0;
+            for (size_t c = coarse_cnt; c < wave_end; ++c) {
+                wave_length += std::min(posting_lists_.Length(scores_coarse[c].first), remain);
+            }
+            if (wave_length < g_ivf_parallel_min_length) {
+                wave_end = coarse_cnt + 1;
+            }
+        }
+#pragma omp parallel for schedule(dynamic) if(coarse_cnt + 1 < wave_end)
+        for (long long c_tmp = (long long) coarse_cnt; c_tmp < static_cast<long long>(wave_end); ++c_tmp) {
+            size_t c = static_cast<size_t>(c_tmp);
+            size_t no = scores_coarse[c].first;
+            auto &list_scores = wave_scores[c - coarse_cnt];
+            list_scores.clear();
+            for (const int32_t *it = posting_lists_.Begin(no); it != posting_lists_.End(no); ++it) {
+                size_t n = static_cast<size_t>(*it);
+                if (it + g_prefetch_distance < posting_lists_.End(no)) {
+                    PrefetchCode(static_cast<size_t>(*(it + g_prefetch_distance)));
+                }
+                // ===== (5) If id is not included in target_ids, skip. =====
+                // Note that if S==0 (target is all), then evaluate all IDs
+                if (S != 0 && !std::binary_search(tids, tids + S, static_cast<long long>(n))) {
+                    continue;
+                }
+
+                // ===== (6) Evaluate n =====
+                list_scores.emplace_back(n, ADist(dtable, flattened_codes_, n));
+                if (list_scores.size() == remain) {
+                    break;
+                }
             }
+        }
 
-            // ===== (6) Evaluate n =====
-            scores.emplace_back(n, ADist(dtable, flattened_codes_, n));
+        // The first codes of the next wave are prefetched while the results are merged
+        if (wave_end < nlist) {
+            size_t no_next = scores_coarse[wave_end].first;
+            const int32_t *end_next = std::min(posting_lists_.Begin(no_next) + g_prefetch_distance, posting_lists_.End(no_next));
+            for (const int32_t *it = posting_lists_.Begin(no_next); it != end_next; ++it) {
+                PrefetchCode(static_cast<size_t>(*it));
+            }
+        }
+
+        for (size_t j = 0, wave_size = wave_end - coarse_cnt; j < wave_size; ++j) {
+            const auto &list_scores = wave_scores[j];
+            coarse_cnt++;
+            size_t num_take = std::min(list_scores.size(), (size_t) L - scores.size());
+            scores.insert(scores.end(), list_scores.begin(), list_scores.begin() + num_take);
 
             // ===== (7) If scores are collected enough =====
             if (scores.size() == (size_t) L) {
                 goto finish;
             }
-        }
 
-        // If w coarse centers are traversed and still L items are not found while more than topk items are found,
-        // we terminate the process and do the final reranking
-        if ( (size_t) coarse_cnt == w && scores.size() >= (unsigned long) topk) {
+            // If w coarse centers are traversed and still L items are not found while more than topk items are found,
+            // we terminate the process and do the final reranking
+            if (coarse_cnt == w && scores.size() >= (unsigned long) topk) {
 finish:
-            // ===== (8) Sort them =====
-            std::partial_sort(scores.begin(), scores.begin() + topk, scores.end(),
-                              [](const std::pair<size_t, float> &a, const std::pair<size_t, float> &b){return a.second < b.second;});
-            scores.resize(topk);
-            scores.shrink_to_fit();
-
-            // ===== (9) Return the result, in the form of pair<vec, vec> =====
-            // Note that this returns two lists, not np.array
-            return PairVectorToVectorPair(scores);
+                // ===== (8) Sort them =====
+                SelectTopk(scores, (size_t) topk);
+                return scores;
+            }
         }
-
     }
 
     // It can be happened that vectors are not found
-    return std::pair<std::vector<size_t>, std::vector<float>>({}, {});
+    return {};
 }
 
 void RiiCpp::Clear()
 {
     coarse_centers_.clear();
     flattened_codes_.clear();
-    posting_lists_.clear();
+    posting_lists_ = PostingListsCSR();
+    fastscan_codes_.clear();
+    codes_soa_.clear();
 }
 
 void RiiCpp::UpdatePostingLists(size_t start, size_t num)
@@ -350,23 +736,464 @@ void RiiCpp::UpdatePostingLists(size_t start, size_t num)
 #pragma omp parallel for
     for (long long n_tmp = 0LL; n_tmp < static_cast<long long>(num); ++n_tmp) {
         size_t n = static_cast<size_t>(n_tmp);
-        assign[n] = clustering_instance.predict_one(NthCode(flattened_codes_, start + n));
+        assign[n] = clustering_instance.predict_one(flattened_codes_.data() + (start + n) * M_);
+    }
+    AppendToPostingLists(start, assign);
+}
+
+void RiiCpp::AppendToPostingLists(size_t start, const std::vector<size_t> &assign)
+{
+    // Add identifiers (start, start + 1, ...) to the posting lists, where start + n is added to assign[n]-th list.
+    // (a) Count the number of new IDs for each list. (b) If a list does not have enough spare room,
+    // the CSR arrays are rebuilt with new spare room (see g_posting_list_spare_divisor). Then (c) append the new IDs.
+    size_t num = assign.size();
+    size_t nlist = GetNumList();
+    PostingListsCSR &lists = posting_lists_;
+    std::vector<int64_t> counts(nlist, 0);
+    for (size_t n = 0; n < num; ++n) {
+        ++counts[assign[n]];
+    }
+
+    bool has_room = true;
+    for (size_t no = 0; no < nlist && has_room; ++no) {
+        has_room = lists.offsets[no] + lists.lengths[no] + counts[no] <= lists.offsets[no + 1];
+    }
+    if (!has_room) {
+        std::vector<int64_t> offsets(nlist + 1, 0);
+        for (size_t no = 0; no < nlist; ++no) {
+            int64_t length = lists.lengths[no] + counts[no];
+            offsets[no + 1] = offsets[no] + length + length / (int64_t) g_posting_list_spare_divisor + 1;
+        }
+        std::vector<int32_t> ids(offsets[nlist]);
+        for (size_t no = 0; no < nlist; ++no) {
+            std::copy(lists.Begin(no), lists.End(no), ids.begin() + offsets[no]);
+        }
+        lists.offsets = std::move(offsets);
+        lists.ids = std::move(ids);
     }
 
     for (size_t n = 0; n < num; ++n) {
-        posting_lists_[assign[n]].push_back((int)(start + n));
+        size_t no = assign[n];
+        lists.ids[lists.offsets[no] + lists.lengths[no]++] = (int32_t) (start + n);
     }
 }
 
-DistanceTable RiiCpp::DTable(const py::array_t<float> &vec) const
+void RiiCpp::UpdateFastScanCodes(size_t start, size_t num)
+{
+    // Pack codes[start] to codes[start + num - 1] into fastscan_codes_.
+    // The codes before start must have been already packed.
+    assert(start + num <= GetN());
+    size_t M2 = (M_ + 1) / 2;
+    size_t num_block = (start + num + 31) / 32;
+    fastscan_codes_.resize(num_block * M2 * 32, 0);  // Padded codes are zero
+    for (size_t n = start; n < start + num; ++n) {
+        size_t b = n / 32;
+        for (size_t m = 0; m < M_; ++m) {
+            unsigned char code = NthCodeMthElement(flattened_codes_, n, m);
+            fastscan_codes_[(b * M2 + m / 2) * 32 + n % 32] |= (m % 2 == 0) ? code : (unsigned char) (code << 4);
+        }
+    }
+}
+
+void RiiCpp::UpdateCodesSoa(size_t start, size_t num)
+{
+    // Copy codes[start] to codes[start + num - 1] into codes_soa_.
+    // The codes before start must have been already copied.
+    assert(start + num <= GetN());
+    size_t num_block = (start + num + 31) / 32;
+    codes_soa_.resize(num_block * M_ * 32, 0);  // Padded codes are zero
+    for (size_t n = start; n < start + num; ++n) {
+        size_t b = n / 32;
+        for (size_t m = 0; m < M_; ++m) {
+            codes_soa_[(b * M_ + m) * 32 + n % 32] = NthCodeMthElement(flattened_codes_, n, m);
+        }
+    }
+}
+
+std::vector<std::pair<size_t, float>> RiiCpp::FastScanCandidates(const DistanceTable &dtable, int topk) const
+{
+    // Run the linear scan with quantized distance tables over fastscan_codes_,
+    // then return the candidates (with exact distances) that can be in the top-k.
+    assert(UseFastScan());
+
+    // ===== (1) Create 8-bit distance tables, where each one has 16 entries =====
+    QuantizedDistanceTable qdtable(dtable);
+    size_t M2 = (M_ + 1) / 2;
+    std::vector<unsigned char> luts(M2 * 2 * 16, 0);  // Tables for padded subspaces are zero
+    for (size_t m = 0; m < M_; ++m) {
+        for (size_t ks = 0; ks < Ks_; ++ks) {
+            luts[m * 16 + ks] = qdtable.GetVal(m, ks);
+        }
+    }
+
+    // ===== (2) Compute quantized distances for each block of 32 codes =====
+    size_t N = GetN();
+    size_t num_block = (N + 31) / 32;
+    std::vector<uint16_t> qdists(num_block * 32);
+    for (size_t b = 0; b < num_block; ++b) {
+        const unsigned char *block = fastscan_codes_.data() + b * M2 * 32;
+#if defined(__AVX2__)
+        const __m256i mask = _mm256_set1_epi8(0x0f);
+        const __m256i zero = _mm256_setzero_si256();
+        // Because unpack works for each 128-bit lane, accum0 has the distances of
+        // codes 0-7 and 16-23, and accum1 has those of codes 8-15 and 24-31
+        __m256i accum0 = _mm256_setzero_si256();
+        __m256i accum1 = _mm256_setzero_si256();
+        for (size_t m2 = 0; m2 < M2; ++m2) {
+            __m256i codes = _mm256_loadu_si256((const __m256i *) (block + m2 * 32));
+            __m256i codes_lo = _mm256_and_si256(codes, mask);
+            __m256i codes_hi = _mm256_and_si256(_mm256_srli_epi16(codes, 4), mask);
+            __m256i lut_lo = _mm256_broadcastsi128_si256(_mm_loadu_si128((const __m128i *) &luts[(2 * m2) * 16]));
+            __m256i lut_hi = _mm256_broadcastsi128_si256(_mm_loadu_si128((const __m128i *) &luts[(2 * m2 + 1) * 16]));
+            __m256i d_lo = _mm256_shuffle_epi8(lut_lo, codes_lo);  // 32 lookups at once
+            __m256i d_hi = _mm256_shuffle_epi8(lut_hi, codes_hi);
+            accum0 = _mm256_adds_epu16(accum0, _mm256_unpacklo_epi8(d_lo, zero));
+            accum1 = _mm256_adds_epu16(accum1, _mm256_unpackhi_epi8(d_lo, zero));
+            accum0 = _mm256_adds_epu16(accum0, _mm256_unpacklo_epi8(d_hi, zero));
+            accum1 = _mm256_adds_epu16(accum1, _mm256_unpackhi_epi8(d_hi, zero));
+        }
+        _mm256_storeu_si256((__m256i *) &qdists[b * 32], _mm256_permute2x128_si256(accum0, accum1, 0x20));
+        _mm256_storeu_si256((__m256i *) &qdists[b * 32 + 16], _mm256_permute2x128_si256(accum0, accum1, 0x31));
+#else
+        for (size_t i = 0; i < 32; ++i) {
+            uint32_t qdist = 0;
+            for (size_t m2 = 0; m2 < M2; ++m2) {
+                unsigned char code = block[m2 * 32 + i];
+                qdist += luts[(2 * m2) * 16 + (code & 0x0f)] + luts[(2 * m2 + 1) * 16 + (code >> 4)];
+            }
+            qdists[b * 32 + i] = (uint16_t) std::min(qdist, (uint32_t) UINT16_MAX);
+        }
+#endif
+    }
+    qdists.resize(N);  // Remove padded codes
+
+    // ===== (3) Evaluate the exact distances of the candidates =====
+    return RerankQuantized(dtable, qdtable, qdists, nullptr, topk);
+}
+
+std::vector<std::pair<size_t, float>> RiiCpp::QuantizedScanCandidates(const DistanceTable &dtable, int topk,
+                                                                      const long long *tids, size_t S) const
+{
+    // Run the linear scan with the 8-bit version of dtable, then return the candidates (with exact distances)
+    // that can be in the top-k. If S == 0, all codes are scanned (over codes_soa_). Otherwise, tids[0], ..., tids[S-1]
+    // are scanned. The 8-bit table is 4x smaller than the float one (e.g., 5KB for M=20 and Ks=256), so it stays in L1 cache.
+    QuantizedDistanceTable qdtable(dtable);
+    if (S == 0) {
+        return RerankQuantized(dtable, qdtable, QuantizedScanSoa(qdtable), nullptr, topk);
+    }
+    const unsigned char *qdt = qdtable.data_.data();
+    size_t num = S;
+    std::vector<uint16_t> qdists(num);
+    // Four codes are processed at once. Unlike float additions, the integer additions are cheap,
+    // so the four independent lookup chains keep the load units busy.
+    const size_t B = 4;
+#pragma omp parallel for
+    for (long long b_tmp = 0LL; b_tmp < static_cast<long long>((num + B - 1) / B); ++b_tmp) {
+        size_t i0 = static_cast<size_t>(b_tmp) * B;
+        size_t nb = std::min(B, num - i0);
+        const unsigned char *codes[B];
+        for (size_t b = 0; b < B; ++b) {
+            size_t i = i0 + std::min(b, nb - 1);  // The last block is padded with its last code
+            codes[b] = flattened_codes_.data() + static_cast<size_t>(tids[i]) * M_;
+            if (i + g_prefetch_distance < num) {
+                PrefetchCode(static_cast<size_t>(tids[i + g_prefetch_distance]));
+            }
+        }
+        uint32_t qdist[B] = {0, 0, 0, 0};
+        for (size_t m = 0; m < M_; ++m) {
+            const unsigned char *qdt_m = qdt + m * Ks_;
+            qdist[0] += qdt_m[codes[0][m]];
+            qdist[1] += qdt_m[codes[1][m]];
+            qdist[2] += qdt_m[codes[2][m]];
+            qdist[3] += qdt_m[codes[3][m]];
+        }
+        for (size_t b = 0; b < nb; ++b) {
+            qdists[i0 + b] = (uint16_t) std::min(qdist[b], (uint32_t) UINT16_MAX);
+        }
+    }
+    return RerankQuantized(dtable, qdtable, qdists, tids, topk);
+}
+
+std::vector<uint16_t> RiiCpp::QuantizedScanSoa(const QuantizedDistanceTable &qdtable) const
+{
+    // Compute the quantized distances of all codes by reading codes_soa_.
+    // In each block, the m-th sub-codes of 32 codes are loaded at once. With AVX2, the table values
+    // for 8 sub-codes are fetched by a single gather, so four gathers per subspace cover the block.
+    assert(!UseFastScan());
+    std::vector<int32_t> lut(qdtable.data_.begin(), qdtable.data_.end());  // Gather reads 32-bit values
+    size_t N = GetN();
+    size_t num_block = (N + 31) / 32;
+    std::vector<uint16_t> qdists(num_block * 32);
+#pragma omp parallel for
+    for (long long b_tmp = 0LL; b_tmp < static_cast<long long>(num_block); ++b_tmp) {
+        size_t b = static_cast<size_t>(b_tmp);
+        const unsigned char *block = codes_soa_.data() + b * M_ * 32;
+#if defined(__AVX2__)
+        __m256i accum[4] = {_mm256_setzero_si256(), _mm256_setzero_si256(),
+                            _mm256_setzero_si256(), _mm256_setzero_si256()};
+        for (size_t m = 0; m < M_; ++m) {
+            const int *lut_m = lut.data() + m * Ks_;
+            for (size_t j = 0; j < 4; ++j) {
+                __m256i codes = _mm256_cvtepu8_epi32(_mm_loadl_epi64((const __m128i *) (block + m * 32 + j * 8)));
+                accum[j] = _mm256_add_epi32(accum[j], _mm256_i32gather_epi32(lut_m, codes, 4));
+            }
+        }
+        for (size_t j = 0; j < 4; ++j) {  // Saturated to UINT16_MAX
+            __m128i qdist = _mm_packus_epi32(_mm256_castsi256_si128(accum[j]), _mm256_extracti128_si256(accum[j], 1));
+            _mm_storeu_si128((__m128i *) &qdists[b * 32 + j * 8], qdist);
+        }
+#else
+        for (size_t i = 0; i < 32; ++i) {
+            uint32_t qdist = 0;
+            for (size_t m = 0; m < M_; ++m) {
+                qdist += (uint32_t) lut[m * Ks_ + block[m * 32 + i]];
+            }
+            qdists[b * 32 + i] = (uint16_t) std::min(qdist, (uint32_t) UINT16_MAX);
+        }
+#endif
+    }
+    qdists.resize(N);  // Remove padded codes
+    return qdists;
+}
+
+std::vector<std::vector<std::pair<size_t, float>>> RiiCpp::QuantizedScanCandidates(const std::vector<DistanceTable> &dtables, int topk,
+                                                                                   const long long *tids, size_t S) const
+{
+    // The same as QuantizedScanCandidates(dtable, topk, tids, S), but for a block of queries (at most g_query_block_size).
+    // The 8-bit tables of the queries are interleaved as (M, Ks, g_query_block_size), so that the values of
+    // a sub-code for all queries are read by a single 8-byte load and summed up at once.
+    // Each code is read once for all queries in the block.
+    const size_t B = g_query_block_size;
+    size_t nq = dtables.size();
+    assert(0 < nq && nq <= B);
+
+    // ===== (1) Create interleaved 8-bit distance tables =====
+    std::vector<unsigned char> luts(M_ * Ks_ * B, 0);  // Tables for padded queries are zero
+    std::vector<QuantizedDistanceTable> qdtables(nq);
+    for (size_t q = 0; q < nq; ++q) {
+        qdtables[q] = QuantizedDistanceTable(dtables[q]);
+        for (size_t i = 0; i < M_ * Ks_; ++i) {
+            luts[i * B + q] = qdtables[q].data_[i];
+        }
+    }
+
+    // ===== (2) Compute quantized distances =====
+    size_t num = (S == 0) ? GetN() : S;
+    std::vector<std::vector<uint16_t>> qdists(nq, std::vector<uint16_t>(num));
+#pragma omp parallel for
+    for (long long i_tmp = 0LL; i_tmp < static_cast<long long>(num); ++i_tmp) {
+        size_t i = static_cast<size_t>(i_tmp);
+        size_t n = (S == 0) ? i : static_cast<size_t>(tids[i]);
+        const unsigned char *code = flattened_codes_.data() + n * M_;
+        if (i + g_prefetch_distance < num) {
+            PrefetchCode((S == 0) ? i + g_prefetch_distance : static_cast<size_t>(tids[i + g_prefetch_distance]));
+        }
+        uint16_t qdist[B];
+#if defined(__SSE4_1__)
+        static_assert(g_query_block_size == 8, "One 128-bit register holds the distances of 8 queries");
+        __m128i accum = _mm_setzero_si128();
+        for (size_t m = 0; m < M_; ++m) {
+            const __m128i d = _mm_loadl_epi64((const __m128i *) &luts[(m * Ks_ + code[m]) * B]);
+            accum = _mm_adds_epu16(accum, _mm_cvtepu8_epi16(d));
+        }
+        _mm_storeu_si128((__m128i *) qdist, accum);
+#else
+        uint32_t qdist32[B] = {0};
+        for (size_t m = 0; m < M_; ++m) {
+            const unsigned char *lut = &luts[(m * Ks_ + code[m]) * B];
+            for (size_t q = 0; q < B; ++q) {
+                qdist32[q] += lut[q];
+            }
+        }
+        for (size_t q = 0; q < B; ++q) {
+            qdist[q] = (uint16_t) std::min(qdist32[q], (uint32_t) UINT16_MAX);
+        }
+#endif
+        for (size_t q = 0; q < nq; ++q) {
+            qdists[q][i] = qdist[q];
+        }
+    }
+
+    // ===== (3) Evaluate the exact distances of the candidates for each query =====
+    std::vector<std::vector<std::pair<size_t, float>>> scores(nq);
+    for (size_t q = 0; q < nq; ++q) {
+        scores[q] = RerankQuantized(dtables[q], qdtables[q], qdists[q], (S == 0) ? nullptr : tids, topk);
+    }
+    return scores;
+}
+
+std::vector<std::pair<size_t, float>> RiiCpp::RerankQuantized(const DistanceTable &dtable,
+                                                              const QuantizedDistanceTable &qdtable,
+                                                              const std::vector<uint16_t> &qdists,
+                                                              const long long *tids,
+                                                              int topk) const
+{
+    // Given the quantized distances of codes, select candidates that can be in the top-k,
+    // and return them with their exact distances. qdists[i] is for the code of tids[i].
+    // If tids == nullptr, qdists[i] is for i-th code.
+    // Let q_k be the k-th smallest quantized distance. Since the true distance of a code with q lies in
+    // [bias + scale * q, bias + scale * (q + M)), the true top-k must be in the codes with q <= q_k + M,
+    // where the errors of float are also taken into account (see QuantizedDistanceTable::Margin).
+    // Note that q is saturated at UINT16_MAX, which does not break this condition.
+    assert(0 < topk && (size_t) topk <= qdists.size());
+    // q_k is found by the histogram of qdists, which is much faster than nth_element for 16-bit values
+    std::vector<uint32_t> hist((size_t) *std::max_element(qdists.begin(), qdists.end()) + 1, 0);
+    for (uint16_t q : qdists) {
+        ++hist[q];
+    }
+    uint32_t qk = 0;
+    for (size_t cnt = 0; (cnt += hist[qk]) < (size_t) topk; ++qk) {}
+    uint32_t thresh = qk + qdtable.Margin(qk);
+
+    std::vector<std::pair<size_t, float>> scores;
+    for (size_t i = 0, num = qdists.size(); i < num; ++i) {
+        if (qdists[i] <= thresh) {
+            size_t n = (tids == nullptr) ? i : static_cast<size_t>(tids[i]);
+            scores.emplace_back(n, ADist(dtable, flattened_codes_, n));
+        }
+    }
+    return scores;
+}
+
+void RiiCpp::PrefetchCode(size_t n) const
+{
+    // Prefetch n-th PQ-code (M bytes) into L1 cache. The code can span two cache lines.
+#if defined(__SSE__)
+    const char *code = (const char *) (flattened_codes_.data() + n * M_);
+    _mm_prefetch(code, _MM_HINT_T0);
+    _mm_prefetch(code + M_ - 1, _MM_HINT_T0);
+#endif
+}
+
+void RiiCpp::UpdateCodewordsSoa()
+{
+    // Transpose codewords_ (M, Ks, Ds) to codewords_soa_ (M, Ds, Ks), so that the distances
+    // from a sub-vector to all codewords can be computed without horizontal summation
+    size_t Ds = codewords_[0][0].size();
+    codewords_soa_.resize(M_ * Ds * Ks_);
+    for (size_t m = 0; m < M_; ++m) {
+        for (size_t ks = 0; ks < Ks_; ++ks) {
+            for (size_t ds = 0; ds < Ds; ++ds) {
+                codewords_soa_[(m * Ds + ds) * Ks_ + ks] = codewords_[m][ks][ds];
+            }
+        }
+    }
+}
+
+void RiiCpp::EncodeVecs(const float *vecs, size_t N, unsigned char *codes) const
+{
+    // Encode N vectors (N * D floats) into codes (N * M), block by block
+    const size_t B = g_encode_block_size;
+    size_t D = M_ * codewords_[0][0].size();
+#pragma omp parallel for
+    for (long long b_tmp = 0LL; b_tmp < static_cast<long long>((N + B - 1) / B); ++b_tmp) {
+        size_t n0 = static_cast<size_t>(b_tmp) * B;
+        EncodeBlock(vecs + n0 * D, std::min(B, N - n0), codes + n0 * M_);
+    }
+}
+
+void RiiCpp::EncodeBlock(const float *vecs, size_t nb, unsigned char *codes) const
+{
+    // Encode nb (<= g_encode_block_size) vectors. The loop over subspaces is outside, so the codewords
+    // of m-th subspace (Ds * Ks floats) are loaded to cache once and reused for all nb sub-vectors.
+    size_t Ds = codewords_[0][0].size();
+    for (size_t m = 0; m < M_; ++m) {
+        for (size_t n = 0; n < nb; ++n) {
+            codes[n * M_ + m] = EncodeSubvector(vecs + n * M_ * Ds + m * Ds, m);
+        }
+    }
+}
+
+unsigned char RiiCpp::EncodeSubvector(const float *subvec, size_t m) const
+{
+    // Return the id of the nearest codeword to subvec (Ds-dim) in m-th subspace.
+    // If several codewords are the nearest, the smallest id is returned (same as std::min_element)
+    size_t Ds = codewords_[0][0].size();
+    const float *cw = codewords_soa_.data() + m * Ds * Ks_;
+    float min_dist = std::numeric_limits<float>::max();
+    size_t min_ks = 0;
+    size_t ks = 0;
+#if defined(__AVX__)
+    // Compute the distances to 8 codewords at once. The minimum and its id are tracked for each lane
+    // without branches (ids are kept as float, which is exact for ks < 2^24), then reduced at the end.
+    // Codewords are processed by blocks of 32 (four registers), so that four independent chains of FMA
+    // run in parallel for each dimension. The remaining codewords are processed by blocks of 8.
+    __m256 mmin = _mm256_set1_ps(std::numeric_limits<float>::max());
+    __m256 mmin_ks = _mm256_setzero_ps();
+    __m256 mks = _mm256_setr_ps(0, 1, 2, 3, 4, 5, 6, 7);
+    const __m256 meight = _mm256_set1_ps(8);
+    auto update_min = [&](const __m256 &msum) {
+        const __m256 mask = _mm256_cmp_ps(msum, mmin, _CMP_LT_OQ);
+        mmin = _mm256_blendv_ps(mmin, msum, mask);
+        mmin_ks = _mm256_blendv_ps(mmin_ks, mks, mask);
+        mks = _mm256_add_ps(mks, meight);
+    };
+    auto accumulate = [](const __m256 &mx, const float *c, __m256 &msum) {
+        const __m256 a_m_b = _mm256_sub_ps(mx, _mm256_loadu_ps(c));
+#if defined(__FMA__)
+        msum = _mm256_fmadd_ps(a_m_b, a_m_b, msum);
+#else
+        msum = _mm256_add_ps(msum, _mm256_mul_ps(a_m_b, a_m_b));
+#endif
+    };
+    for (; ks + 32 <= Ks_; ks += 32) {
+        __m256 msum0 = _mm256_setzero_ps(), msum1 = _mm256_setzero_ps();
+        __m256 msum2 = _mm256_setzero_ps(), msum3 = _mm256_setzero_ps();
+        for (size_t ds = 0; ds < Ds; ++ds) {
+            const __m256 mx = _mm256_broadcast_ss(subvec + ds);
+            const float *c = cw + ds * Ks_ + ks;
+            accumulate(mx, c, msum0);
+            accumulate(mx, c + 8, msum1);
+            accumulate(mx, c + 16, msum2);
+            accumulate(mx, c + 24, msum3);
+        }
+        update_min(msum0);
+        update_min(msum1);
+        update_min(msum2);
+        update_min(msum3);
+    }
+    for (; ks + 8 <= Ks_; ks += 8) {
+        __m256 msum = _mm256_setzero_ps();
+        for (size_t ds = 0; ds < Ds; ++ds) {
+            accumulate(_mm256_broadcast_ss(subvec + ds), cw + ds * Ks_ + ks, msum);
+        }
+        update_min(msum);
+    }
+    if (8 <= Ks_) {
+        float mins[8], min_kss[8];
+        _mm256_storeu_ps(mins, mmin);
+        _mm256_storeu_ps(min_kss, mmin_ks);
+        min_dist = mins[0];
+        min_ks = (size_t) min_kss[0];
+        for (int i = 1; i < 8; ++i) {
+            if (mins[i] < min_dist || (mins[i] == min_dist && (size_t) min_kss[i] < min_ks)) {
+                min_dist = mins[i];
+                min_ks = (size_t) min_kss[i];
+            }
+        }
+    }
+#endif
+    for (; ks < Ks_; ++ks) {
+        float dist = 0;
+        for (size_t ds = 0; ds < Ds; ++ds) {
+            const float a_m_b = subvec[ds] - cw[ds * Ks_ + ks];
+            dist += a_m_b * a_m_b;
+        }
+        if (dist < min_dist) {
+            min_dist = dist;
+            min_ks = ks;
+        }
+    }
+    return (unsigned char) min_ks;
+}
+
+DistanceTable RiiCpp::DTable(const float *vec) const
 {
-    const auto &v = vec.unchecked<1>();
     size_t Ds = codewords_[0][0].size();
-    assert((size_t) v.shape(0) == M_ * Ds);
     DistanceTable dtable(M_, Ks_);
     for (size_t m = 0; m < M_; ++m) {
         for (size_t ks = 0; ks < Ks_; ++ks) {
-            dtable.SetVal(m, ks, fvec_L2sqr(&(v(m * Ds)), codewords_[m][ks].data(), Ds));
+            dtable.SetVal(m, ks, fvec_L2sqr(vec + m * Ds, codewords_[m][ks].data(), Ds));
         }
     }
     return dtable;
@@ -375,32 +1202,77 @@ DistanceTable RiiCpp::DTable(const py::array_t<float> &vec) const
 float RiiCpp::ADist(const DistanceTable &dtable, const std::vector<unsigned char> &code) const
 {
     assert(code.size() == M_);
-    float dist = 0;
-    for (size_t m = 0; m < M_; ++m) {
-        unsigned char ks = code[m];
-        dist += dtable.GetVal(m, ks);
-    }
-    return dist;
+    return ADist(dtable, code.data());
 }
 
 float RiiCpp::ADist(const DistanceTable &dtable, const std::vector<unsigned char> &flattened_codes, size_t n) const
 {
+    return ADist(dtable, flattened_codes.data() + n * M_);
+}
+
+float RiiCpp::ADist(const DistanceTable &dtable, const unsigned char *code) const
+{
+    // Sum up dtable.GetVal(m, code[m]) for m = 0, ..., M-1. With AVX2, the values of 8 subspaces are fetched
+    // by a single gather from the flattened dtable, where the index of (m, code[m]) is m * Ks + code[m].
+    // Every exact distance (the scans and the reranking) is computed here, so a code always gets the same value.
+    const float *dt = dtable.data_.data();
     float dist = 0;
-    for (size_t m = 0; m < M_; ++m) {
-        unsigned char ks = NthCodeMthElement(flattened_codes, n, m);
-        dist += dtable.GetVal(m, ks);
+    size_t m = 0;
+#if defined(__AVX2__)
+    if (8 <= M_) {
+        const __m256i mstep = _mm256_set1_epi32((int) (8 * Ks_));
+        __m256i moffset = _mm256_mullo_epi32(_mm256_setr_epi32(0, 1, 2, 3, 4, 5, 6, 7), _mm256_set1_epi32((int) Ks_));
+        __m256 msum = _mm256_setzero_ps();
+        for (; m + 8 <= M_; m += 8) {
+            const __m256i mcode = _mm256_cvtepu8_epi32(_mm_loadl_epi64((const __m128i *) (code + m)));
+            msum = _mm256_add_ps(msum, _mm256_i32gather_ps(dt, _mm256_add_epi32(mcode, moffset), 4));
+            moffset = _mm256_add_epi32(moffset, mstep);
+        }
+        __m128 msum2 = _mm_add_ps(_mm256_castps256_ps128(msum), _mm256_extractf128_ps(msum, 1));
+        msum2 = _mm_hadd_ps(msum2, msum2);
+        msum2 = _mm_hadd_ps(msum2, msum2);
+        dist = _mm_cvtss_f32(msum2);
+    }
+#endif
+    for (; m < M_; ++m) {
+        dist += dt[m * Ks_ + code[m]];
     }
     return dist;
 }
 
-std::pair<std::vector<size_t>, std::vector<float> > RiiCpp::PairVectorToVectorPair(const std::vector<std::pair<size_t, float> > &pair_vec) const
+std::pair<py::array_t<long long>, py::array_t<float>> RiiCpp::PairVectorToArrayPair(const std::vector<std::pair<size_t, float> > &pair_vec) const
+{
+    size_t K = pair_vec.size();
+    py::array_t<long long> ids(K);
+    py::array_t<float> dists(K);
+    long long *ids_ptr = ids.mutable_data();
+    float *dists_ptr = dists.mutable_data();
+    for(size_t k = 0; k < K; ++k) {
+        ids_ptr[k] = (long long) pair_vec[k].first;
+        dists_ptr[k] = pair_vec[k].second;
+    }
+    return std::make_pair(ids, dists);
+}
+
+std::pair<py::array_t<long long>, py::array_t<float>> RiiCpp::PairVectorsToArrayPair(const std::vector<std::vector<std::pair<size_t, float>>> &pair_vecs,
+                                                                                     int topk) const
 {
-    std::pair<std::vector<size_t>, std::vector<float>> vec_pair(std::vector<size_t>(pair_vec.size()), std::vector<float>(pair_vec.size()));
-    for(size_t n = 0, N = pair_vec.size(); n < N; ++n) {
-        vec_pair.first[n] = pair_vec[n].first;
-        vec_pair.second[n] = pair_vec[n].second;
+    // The results of Nq queries are stored in (Nq, topk) arrays.
+    // If a result has less than topk items, the rest are filled by id=-1 and dist=inf
+    size_t Nq = pair_vecs.size();
+    py::array_t<long long> ids({Nq, (size_t) topk});
+    py::array_t<float> dists({Nq, (size_t) topk});
+    long long *ids_ptr = ids.mutable_data();
+    float *dists_ptr = dists.mutable_data();
+    std::fill(ids_ptr, ids_ptr + Nq * topk, -1);
+    std::fill(dists_ptr, dists_ptr + Nq * topk, std::numeric_limits<float>::infinity());
+    for (size_t q = 0; q < Nq; ++q) {
+        for (size_t k = 0, K = pair_vecs[q].size(); k < K; ++k) {
+            ids_ptr[q * topk + k] = (long long) pair_vecs[q][k].first;
+            dists_ptr[q * topk + k] = pair_vecs[q][k].second;
+        }
     }
-    return vec_pair;
+    return std::make_pair(ids, dists);
 }
 
 
@@ -4,14 +4,29 @@ import numpy as np
 import nanopq
 
 
+class RiiWithName(rii.Rii):
+    # A subclass with an extra attribute, for test_pickle
+    def __init__(self, fine_quantizer, name):
+        super().__init__(fine_quantizer=fine_quantizer)
+        self.name = name
+
+
 class TestSuite(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The datasets shared by all tests. They are created only once, directly as float32.
+        # Y is another set from the same distribution, e.g., to be merged with X
+        rng = np.random.default_rng(123)
+        cls.X = rng.random((1000, 40), dtype=np.float32)
+        cls.Y = rng.random((500, 40), dtype=np.float32)
+
     def setUp(self):
-        np.random.seed(123)
+        np.random.seed(123)  # PQ/OPQ training uses the global random state
 
     def test_construct(self):
         M, Ks = 4, 20
         N, D = 1000, 40
-        X = np.random.random((N, D)).astype(np.float32)
+        X = self.X
         e = rii.Rii(fine_quantizer=nanopq.PQ(M=M, Ks=Ks, verbose=True).fit(vecs=X))
         self.assertEqual(e.fine_quantizer.codewords.shape, (M, Ks, D/M))
         self.assertEqual((e.M, e.Ks), (M, Ks))
@@ -23,7 +38,7 @@ class TestSuite(unittest.TestCase):
         for codec in [nanopq.PQ, nanopq.OPQ]:
             M, Ks = 4, 20
             N, D = 1000, 40
-            X = np.random.random((N, D)).astype(np.float32)
+            X = self.X
             e = rii.Rii(fine_quantizer=codec(M=M, Ks=Ks, verbose=True).fit(vecs=X))
 
             self.assertEqual(e.N, 0)
@@ -39,11 +54,18 @@ class TestSuite(unittest.TestCase):
             e.add(vecs=X, update_posting_lists=False)
             self.assertEqual(e.N, 2 * N)
 
+        # Ks=256 runs the blocks of 32 codewords in the encoding, and Ks=33 leaves a remainder
+        for codec in [nanopq.PQ, nanopq.OPQ]:
+            for M, Ks in [(4, 256), (4, 33)]:
+                e = rii.Rii(fine_quantizer=codec(M=M, Ks=Ks, verbose=True).fit(vecs=self.X))
+                e.add(vecs=self.X, update_posting_lists=False)
+                self.assertTrue(np.array_equal(e.fine_quantizer.encode(self.X), e.codes))
+
     def test_reconfigure(self):
         for codec in [nanopq.PQ, nanopq.OPQ]:
             M, Ks = 4, 20
             N, D = 1000, 40
-            X = np.random.random((N, D)).astype(np.float32)
+            X = self.X
             e = rii.Rii(fine_quantizer=codec(M=M, Ks=Ks, verbose=True).fit(vecs=X))
             e.add(vecs=X, update_posting_lists=False)
             for nlist in [5, 100]:
@@ -56,8 +78,7 @@ class TestSuite(unittest.TestCase):
     def test_simple_add_configure(self):
         M, Ks = 4, 20
         N1, N2, D = 300, 700, 40
-        X1 = np.random.random((N1, D)).astype(np.float32)
-        X2 = np.random.random((N2, D)).astype(np.float32)
+        X1, X2 = self.X[:N1], self.X[N1:]
         e = rii.Rii(fine_quantizer=nanopq.PQ(M=M, Ks=Ks, verbose=True).fit(vecs=X1))
         e.add(vecs=X1)
         self.assertEqual(e.N, N1)
@@ -70,10 +91,56 @@ class TestSuite(unittest.TestCase):
             self.assertEqual(len(e.posting_lists), nlist)
             self.assertEqual(sum([len(plist) for plist in e.posting_lists]), N1 + N2)
 
+    def test_add_update_posting_lists(self):
+        for codec in [nanopq.PQ, nanopq.OPQ]:
+            M, Ks = 4, 20
+            N1, N2, D = 300, 700, 40
+            X1, X2 = self.X[:N1], self.X[N1:]
+            e1 = rii.Rii(fine_quantizer=codec(M=M, Ks=Ks, verbose=True).fit(vecs=X1)).add_configure(vecs=X1)
+            e2 = rii.Rii(fine_quantizer=e1.fine_quantizer).add_configure(vecs=X1)
+            # Encoding and assignment are done at once.
+            # The result should be the same as encoding first then assigning.
+            e1.add(vecs=X2)
+            e2.impl_cpp.add_codes(e2.impl_cpp.encode(e2._rotate(X2)), True)
+            self.assertTrue(np.array_equal(e1.codes, e2.codes))
+            self.assertListEqual(e1.posting_lists, e2.posting_lists)
+
+            # Added one by one. IDs are appended to the spare room of the posting lists, or the lists are rebuilt
+            e3 = rii.Rii(fine_quantizer=e1.fine_quantizer).add_configure(vecs=X1)
+            for x in X2:
+                e3.add(vecs=x.reshape(1, -1))
+            self.assertTrue(np.array_equal(e1.codes, e3.codes))
+            self.assertListEqual(e1.posting_lists, e3.posting_lists)
+            for q in X2[:5]:
+                ids1, dists1 = e1.query(q=q, topk=10, L=N1 + N2)
+                ids3, dists3 = e3.query(q=q, topk=10, L=N1 + N2)
+                self.assertTrue(np.array_equal(ids1, ids3))
+                self.assertTrue(np.array_equal(dists1, dists3))
+
+            # Posting lists cannot be updated before the coarse centers are computed
+            e4 = rii.Rii(fine_quantizer=e1.fine_quantizer)
+            with self.assertRaises(RuntimeError):
+                e4.add(vecs=X2, update_posting_lists=True)
+            with self.assertRaises(RuntimeError):
+                e4.impl_cpp.add_codes(e4.impl_cpp.encode(e4._rotate(X2)), True)
+
+    def test_rotate(self):
+        M, Ks = 4, 20
+        X = self.X
+        e = rii.Rii(fine_quantizer=nanopq.OPQ(M=M, Ks=Ks, verbose=True).fit(vecs=X))
+        for R in [e.fine_quantizer.R, e.fine_quantizer.R.astype(np.float64)]:
+            e.fine_quantizer.R = R
+            # All vectors are rotated at once into a C-contiguous float32 array, even if R is float64
+            X_rot = e._rotate(X)
+            self.assertEqual(X_rot.dtype, np.float32)
+            self.assertTrue(X_rot.flags["C_CONTIGUOUS"])
+            self.assertTrue(np.allclose(X_rot, X @ R, atol=1e-5))
+            self.assertTrue(np.allclose(e._rotate(X[0]), X_rot[0], atol=1e-5))
+
     def test_add_configure(self):
         M, Ks = 4, 20
         N, D = 1000, 40
-        X = np.random.random((N, D)).astype(np.float32)
+        X = self.X
         e1 = rii.Rii(fine_quantizer=nanopq.PQ(M=M, Ks=Ks, verbose=True).fit(vecs=X))
         e1.add_configure(vecs=X, nlist=20)
         e2 = rii.Rii(fine_quantizer=nanopq.PQ(M=M, Ks=Ks, verbose=True).fit(vecs=X))
@@ -92,7 +159,7 @@ class TestSuite(unittest.TestCase):
         import copy
         M, Ks = 4, 20
         N, D = 1000, 40
-        X = np.random.random((N, D)).astype(np.float32)
+        X = self.X
         e1 = rii.Rii(fine_quantizer=nanopq.PQ(M=M, Ks=Ks, verbose=True).fit(vecs=X))
         e2 = copy.deepcopy(e1)
         e3 = copy.deepcopy(e1)
@@ -115,82 +182,82 @@ class TestSuite(unittest.TestCase):
 
 
     def test_query_linear(self):
-        M, Ks = 4, 20
-        N, D = 1000, 40
-        X = np.random.random((N, D)).astype(np.float32)
-        e = rii.Rii(fine_quantizer=nanopq.PQ(M=M, Ks=Ks, verbose=True).fit(vecs=X))
-        e.add_configure(vecs=X, nlist=20)
+        for M, Ks in [(8, 16), (4, 20)]:  # Ks=16 runs the fast scan
+            N, D = 1000, 40
+            X = self.X
+            e = rii.Rii(fine_quantizer=nanopq.PQ(M=M, Ks=Ks, verbose=True).fit(vecs=X))
+            e.add_configure(vecs=X, nlist=20)
+
+            for n, q in enumerate(X[:10]):
+                topk = 10
+                ids1, dists1 = e.impl_cpp.query_linear(q, topk, np.array([], dtype=np.int64))
+                self.assertTrue(isinstance(ids1, np.ndarray))
+                self.assertEqual(ids1.dtype, np.int64)
+                self.assertTrue(isinstance(dists1, np.ndarray))
+                self.assertEqual(dists1.dtype, np.float32)
+                self.assertEqual(len(ids1), topk)
+                self.assertEqual(len(ids1), len(dists1))
+                self.assertTrue(np.all(0 <= np.diff(dists1)))  # Make sure dists1 is sorted
+                # The true NN is included in top 10 with high prob
+                self.assertTrue(n in ids1)
 
-        for n, q in enumerate(X[:10]):
-            topk = 10
-            ids1, dists1 = e.impl_cpp.query_linear(q, topk, np.array([], dtype=np.int64))
-            self.assertTrue(isinstance(ids1, list))
-            self.assertTrue(isinstance(ids1[0], int))
-            self.assertTrue(isinstance(dists1, list))
-            self.assertTrue(isinstance(dists1[0], float))
-            self.assertEqual(len(ids1), topk)
-            self.assertEqual(len(ids1), len(dists1))
-            self.assertTrue(np.all(0 <= np.diff(dists1)))  # Make sure dists1 is sorted
-            # The true NN is included in top 10 with high prob
-            self.assertTrue(n in ids1)
-
-            # Subset search w/ a full indices should be the same w/o target
-            ids2, dists2 = e.impl_cpp.query_linear(q, topk, np.arange(N, dtype=np.int64))
-            self.assertListEqual(ids1, ids2)
-            self.assertListEqual(dists1, dists2)
+                # Subset search w/ a full indices should be the same w/o target
+                ids2, dists2 = e.impl_cpp.query_linear(q, topk, np.arange(N, dtype=np.int64))
+                self.assertTrue(np.array_equal(ids1, ids2))
+                self.assertTrue(np.array_equal(dists1, dists2))
 
-            S = np.array([2, 24, 43, 55, 102, 139, 221, 542, 667, 873, 874, 899], dtype=np.int64)
-            ids3, dists3 = e.impl_cpp.query_linear(q, topk, S)
-            self.assertTrue(np.all([id in S for id in ids3]))
+                S = np.array([2, 24, 43, 55, 102, 139, 221, 542, 667, 873, 874, 899], dtype=np.int64)
+                ids3, dists3 = e.impl_cpp.query_linear(q, topk, S)
+                self.assertTrue(np.all([id in S for id in ids3]))
 
     def test_query_ivf(self):
-        M, Ks = 20, 256
-        N, D = 1000, 40
-        X = np.random.random((N, D)).astype(np.float32)
-        e = rii.Rii(fine_quantizer=nanopq.PQ(M=M, Ks=Ks, verbose=True).fit(vecs=X))
-        e.add_configure(vecs=X, nlist=20)
+        for M, Ks in [(8, 16), (20, 256)]:  # Ks=16 runs the fast scan
+            N, D = 1000, 40
+            X = self.X
+            e = rii.Rii(fine_quantizer=nanopq.PQ(M=M, Ks=Ks, verbose=True).fit(vecs=X))
+            e.add_configure(vecs=X, nlist=20)
 
-        for n, q in enumerate(X[:10]):
-            L = 200
-            topk = 10
-            ids1, dists1 = e.impl_cpp.query_ivf(q, topk, np.array([], dtype=np.int64), L)
-            self.assertTrue(isinstance(ids1, list))
-            self.assertTrue(isinstance(ids1[0], int))
-            self.assertTrue(isinstance(dists1, list))
-            self.assertTrue(isinstance(dists1[0], float))
-            self.assertEqual(len(ids1), topk)
-            self.assertEqual(len(ids1), len(dists1))
-            self.assertTrue(np.all(0 <= np.diff(dists1)))  # Make sure dists1 is sorted
-            # The true NN is included in top 10 with high prob
-            # This might fail if the parameters are severe
-            self.assertTrue(n in ids1)
-
-            # Subset search w/ a full indices should be the same w/o target
-            ids2, dists2 = e.impl_cpp.query_ivf(q, topk, np.arange(N, dtype=np.int64), L)
-            self.assertListEqual(ids1, ids2)
-            self.assertListEqual(dists1, dists2)
+            for n, q in enumerate(X[:10]):
+                L = 200
+                topk = 10
+                ids1, dists1 = e.impl_cpp.query_ivf(q, topk, np.array([], dtype=np.int64), L)
+                self.assertTrue(isinstance(ids1, np.ndarray))
+                self.assertEqual(ids1.dtype, np.int64)
+                self.assertTrue(isinstance(dists1, np.ndarray))
+                self.assertEqual(dists1.dtype, np.float32)
+                self.assertEqual(len(ids1), topk)
+                self.assertEqual(len(ids1), len(dists1))
+                self.assertTrue(np.all(0 <= np.diff(dists1)))  # Make sure dists1 is sorted
+                # The true NN is included in top 10 with high prob
+                # This might fail if the parameters are severe
+                self.assertTrue(n in ids1)
 
-            S = np.array([2, 24, 43, 55, 102, 139, 221, 542, 667, 873, 874, 899], dtype=np.int64)
-            ids3, dists3 = e.impl_cpp.query_ivf(q, topk, S, L)
-            self.assertTrue(np.all([id in S for id in ids3]))
+                # Subset search w/ a full indices should be the same w/o target
+                ids2, dists2 = e.impl_cpp.query_ivf(q, topk, np.arange(N, dtype=np.int64), L)
+                self.assertTrue(np.array_equal(ids1, ids2))
+                self.assertTrue(np.array_equal(dists1, dists2))
 
-            # When target_ids is all vectors and L=all, the results is the same as linear PQ scan
-            ids4, dists4 = e.impl_cpp.query_ivf(q, topk, np.arange(N, dtype=np.int64), N)
-            ids5, dists5 = e.impl_cpp.query_linear(q, topk, np.array([], dtype=np.int64))
-            self.assertListEqual(ids4, ids5)
-            self.assertListEqual(dists4, dists5)
+                S = np.array([2, 24, 43, 55, 102, 139, 221, 542, 667, 873, 874, 899], dtype=np.int64)
+                ids3, dists3 = e.impl_cpp.query_ivf(q, topk, S, L)
+                self.assertTrue(np.all([id in S for id in ids3]))
+
+                # When target_ids is all vectors and L=all, the results is the same as linear PQ scan
+                ids4, dists4 = e.impl_cpp.query_ivf(q, topk, np.arange(N, dtype=np.int64), N)
+                ids5, dists5 = e.impl_cpp.query_linear(q, topk, np.array([], dtype=np.int64))
+                self.assertTrue(np.array_equal(ids4, ids5))
+                self.assertTrue(np.array_equal(dists4, dists5))
 
-            # When target_ids is specified and L is large, linear and ivf should produce the same result
-            ids6, dists6 = e.impl_cpp.query_ivf(q, topk, S, L)
-            ids7, dists7 = e.impl_cpp.query_linear(q, topk, S)
-            self.assertListEqual(ids6, ids7)
-            self.assertListEqual(dists6, dists7)
+                # When target_ids is specified and L is large, linear and ivf should produce the same result
+                ids6, dists6 = e.impl_cpp.query_ivf(q, topk, S, L)
+                ids7, dists7 = e.impl_cpp.query_linear(q, topk, S)
+                self.assertTrue(np.array_equal(ids6, ids7))
+                self.assertTrue(np.array_equal(dists6, dists7))
 
     def test_query(self):
         for codec in [nanopq.PQ, nanopq.OPQ]:
             M, Ks = 20, 256
             N, D = 1000, 40
-            X = np.random.random((N, D)).astype(np.float32)
+            X = self.X
             e = rii.Rii(fine_quantizer=codec(M=M, Ks=Ks, verbose=True).fit(vecs=X))
             e.add_configure(vecs=X, nlist=20)
 
@@ -217,10 +284,64 @@ class TestSuite(unittest.TestCase):
                 ids3, dists3 = e.query(q=q, topk=5, target_ids=S)
                 self.assertTrue(np.all([id in S for id in ids3]))
 
+    def test_query_ties(self):
+        M, Ks = 4, 20
+        N, D = 1000, 40
+        X = self.X
+        e = rii.Rii(fine_quantizer=nanopq.PQ(M=M, Ks=Ks, verbose=True).fit(vecs=X))
+        e.add_configure(vecs=np.tile(X[:100], (10, 1)), nlist=20)  # Each code appears 10 times
+
+        # Items with the same distance are sorted by their identifiers
+        for method, L in [("linear", None), ("ivf", N)]:
+            ids, dists = e.query(q=X[0], topk=30, L=L, method=method)
+            for i in range(len(ids) - 1):
+                self.assertTrue(dists[i] < dists[i + 1] or (dists[i] == dists[i + 1] and ids[i] < ids[i + 1]))
+
+    def test_query_batch(self):
+        for codec in [nanopq.PQ, nanopq.OPQ]:
+            M, Ks = 20, 256
+            N, D = 1000, 40
+            X = self.X
+            e = rii.Rii(fine_quantizer=codec(M=M, Ks=Ks, verbose=True).fit(vecs=X))
+            e.add_configure(vecs=X, nlist=20)
+
+            Q = X[:10]
+            S = np.array([2, 24, 43, 55, 102, 139, 221, 542, 667, 873, 874, 899], dtype=np.int64)
+            for topk, target_ids in [(50, None), (5, S)]:
+                for method in ["auto", "linear", "ivf"]:
+                    ids, dists = e.query_batch(Q=Q, topk=topk, target_ids=target_ids, method=method)
+                    self.assertEqual(ids.shape, (len(Q), topk))
+                    self.assertEqual(ids.dtype, np.int64)
+                    self.assertEqual(dists.shape, (len(Q), topk))
+                    self.assertEqual(dists.dtype, np.float64)
+                    # The result of each query should be the same as that of query()
+                    for q, ids1, dists1 in zip(Q, ids, dists):
+                        ids2, dists2 = e.query(q=q, topk=topk, target_ids=target_ids, method=method)
+                        self.assertTrue(np.array_equal(ids1, ids2))
+                        self.assertTrue(np.allclose(dists1, dists2))
+
+    def test_query_threads(self):
+        M, Ks = 20, 256
+        N, D = 1000, 40
+        X = self.X
+        e = rii.Rii(fine_quantizer=nanopq.PQ(M=M, Ks=Ks, verbose=True).fit(vecs=X))
+        e.add_configure(vecs=X, nlist=20)
+
+        # The queries run without the GIL. The results from several threads should be the same as sequential ones
+        from concurrent.futures import ThreadPoolExecutor
+        Q = X[:20]
+        for method in ["linear", "ivf"]:
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                results = list(pool.map(lambda q: e.query(q=q, topk=10, method=method), Q))
+            for q, (ids1, dists1) in zip(Q, results):
+                ids2, dists2 = e.query(q=q, topk=10, method=method)
+                self.assertTrue(np.array_equal(ids1, ids2))
+                self.assertTrue(np.array_equal(dists1, dists2))
+
     def test_pickle(self):
         M, Ks = 10, 256
         N, D = 1000, 40
-        X = np.random.random((N, D)).astype(np.float32)
+        X = self.X
         e1 = rii.Rii(fine_quantizer=nanopq.PQ(M=M, Ks=Ks, verbose=True).fit(vecs=X))
         e1.add_configure(vecs=X, nlist=20)
 
@@ -235,10 +356,83 @@ class TestSuite(unittest.TestCase):
         for pl1, pl2 in zip(e1.posting_lists, e2.posting_lists):
             self.assertListEqual(pl1, pl2)
 
+        # The codes for the scan are restored as well
+        for q in X[:5]:
+            ids1, dists1 = e1.query(q=q, topk=10, method="linear")
+            ids2, dists2 = e2.query(q=q, topk=10, method="linear")
+            self.assertTrue(np.array_equal(ids1, ids2))
+            self.assertTrue(np.array_equal(dists1, dists2))
+
+        # With protocol 5, the codes, the coarse centers, and the posting lists are out-of-band buffers
+        buffers = []
+        dumped = pickle.dumps(e1, protocol=5, buffer_callback=buffers.append)
+        e3 = pickle.loads(dumped, buffers=buffers)
+        self.assertLess(len(dumped), e1.N * e1.M)
+        self.assertEqual((e1.M, e1.Ks, e1.N, e1.nlist), (e3.M, e3.Ks, e3.N, e3.nlist))
+        self.assertTrue(np.array_equal(e1.coarse_centers, e3.coarse_centers))
+        self.assertTrue(np.array_equal(e1.codes, e3.codes))
+        self.assertEqual(e1.posting_lists, e3.posting_lists)
+        for q in X[:5]:
+            ids1, dists1 = e1.query(q=q, topk=10)
+            ids3, dists3 = e3.query(q=q, topk=10)
+            self.assertTrue(np.array_equal(ids1, ids3))
+            self.assertTrue(np.array_equal(dists1, dists3))
+
+        # The class and the extra attributes of a subclass are kept
+        e4 = RiiWithName(fine_quantizer=e1.fine_quantizer, name="foo")
+        e4.add_configure(vecs=X, nlist=20)
+        buffers = []
+        for dumped in [pickle.dumps(e4, protocol=4), pickle.dumps(e4, protocol=5, buffer_callback=buffers.append)]:
+            e5 = pickle.loads(dumped, buffers=buffers)
+            self.assertIs(type(e5), RiiWithName)
+            self.assertEqual((e4.name, e4.threshold, e4.N), (e5.name, e5.threshold, e5.N))
+            for q in X[:5]:
+                ids4, dists4 = e4.query(q=q, topk=10)
+                ids5, dists5 = e5.query(q=q, topk=10)
+                self.assertTrue(np.array_equal(ids4, ids5))
+                self.assertTrue(np.array_equal(dists4, dists5))
+
+    def test_query_linear_incremental_add(self):
+        M, Ks = 10, 256
+        N, D = 1000, 40
+        X = self.X
+        e = rii.Rii(fine_quantizer=nanopq.PQ(M=M, Ks=Ks, verbose=True).fit(vecs=X))
+        # Added by chunks whose sizes are not multiples of the block size of the scan
+        for start, end in [(0, 50), (50, 127), (127, 600), (600, N)]:
+            e.add(vecs=X[start:end])
+        e.reconfigure(nlist=20)
+
+        # Scanning all codes and scanning the codes specified by target_ids should be the same
+        for q in X[:5]:
+            ids1, dists1 = e.query(q=q, topk=10, method="linear")
+            ids2, dists2 = e.query(q=q, topk=10, target_ids=np.arange(N, dtype=np.int64), method="linear")
+            self.assertTrue(np.array_equal(ids1, ids2))
+            self.assertTrue(np.array_equal(dists1, dists2))
+
+    def test_query_linear_far_query(self):
+        # For a query far from the data, the distances are much larger than the differences among them.
+        # Even so, the linear scan (with 8-bit tables) should return the same result as the exact scan
+        N, D = 1000, 40
+        X = self.X.copy()
+        X[:, 20:] = 0
+        Q = X[:10].copy()
+        Q[:, 20:] = 1000
+        for M, Ks in [(20, 16), (20, 256)]:  # Ks=16 runs the fast scan
+            e = rii.Rii(fine_quantizer=nanopq.PQ(M=M, Ks=Ks, verbose=True).fit(vecs=X))
+            e.add_configure(vecs=X, nlist=20)
+            ids_batch, dists_batch = e.query_batch(Q=Q, topk=10, method="linear")
+            for q, ids3, dists3 in zip(Q, ids_batch, dists_batch):
+                ids1, dists1 = e.impl_cpp.query_linear(q, 10, np.array([], dtype=np.int64))
+                ids2, dists2 = e.impl_cpp.query_ivf(q, 10, np.arange(N, dtype=np.int64), N)  # Evaluates all
+                self.assertTrue(np.array_equal(ids1, ids2))
+                self.assertTrue(np.array_equal(dists1, dists2))
+                self.assertTrue(np.array_equal(ids1, ids3))
+                self.assertTrue(np.array_equal(dists1, dists3))
+
     def test_clear(self):
         M, Ks = 4, 20
         N, D = 1000, 40
-        X = np.random.random((N, D)).astype(np.float32)
+        X = self.X
         e = rii.Rii(fine_quantizer=nanopq.PQ(M=M, Ks=Ks, verbose=True).fit(vecs=X))
         e.add_configure(vecs=X, nlist=20)
         e.clear()
@@ -252,8 +446,7 @@ class TestSuite(unittest.TestCase):
     def test_merge(self):
         from itertools import chain
         M, Ks, N1, N2, D = 4, 20, 1000, 500, 40
-        X1 = np.random.random((N1, D)).astype(np.float32)
-        X2 = np.random.random((N2, D)).astype(np.float32)
+        X1, X2 = self.X, self.Y
         codec = nanopq.PQ(M=M, Ks=Ks, verbose=True).fit(vecs=X1)
         e1 = rii.Rii(fine_quantizer=codec)
         e2 = rii.Rii(fine_quantizer=codec)